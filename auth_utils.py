@@ -1,26 +1,68 @@
 # my-english-corrector-backend/auth_utils.py
-import os
+import hashlib
+import logging
+import time
+import threading
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from dotenv import load_dotenv
-from pydantic import BaseModel, ValidationError
+import jwt
+import orjson
+from jwt import PyJWTError as JWTError
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
 
-load_dotenv()
+from config import get_settings
 
-SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+logger = logging.getLogger(__name__)
+
+SUPABASE_JWT_SECRET = get_settings().supabase_jwt_secret
 ALGORITHM = "HS256" # Supabase usa HS256 con el JWT Secret simple
 
 if not SUPABASE_JWT_SECRET:
-    print("ERROR CRÍTICO: SUPABASE_JWT_SECRET no está configurado en el archivo .env. La autenticación fallará.")
-    # En un entorno de producción, considera lanzar una excepción para detener la aplicación.
-    # raise EnvironmentError("SUPABASE_JWT_SECRET no está configurado en el archivo .env")
+    # Sin secreto todas las peticiones autenticadas fallarían: mejor no arrancar.
+    logger.critical("SUPABASE_JWT_SECRET no está configurado en el archivo .env. La autenticación fallará.")
+    raise RuntimeError("SUPABASE_JWT_SECRET missing")
+
+# Supabase firma con el JWT Secret tal cual (como texto, no decodificado de base64), así que
+# basta con convertirlo a bytes una sola vez para no repetirlo en cada decode.
+_SECRET_BYTES: bytes = SUPABASE_JWT_SECRET.encode()
+
+class _OrjsonPyJWT(jwt.PyJWT):
+    """PyJWT que decodifica el payload con orjson en lugar del módulo json estándar."""
+
+    def _decode_payload(self, decoded: dict) -> dict:
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}") from e
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+_jwt_decoder = _OrjsonPyJWT()
 
 # El tokenUrl no es estrictamente necesario aquí ya que Supabase maneja la obtención del token,
 # pero FastAPI lo requiere para la documentación OpenAPI.
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token") # "auth/token" es un placeholder
 
+# Cabeceras del 401, compartidas. La excepción en sí se crea en cada rechazo: una instancia global
+# guardaría en __context__/__traceback__ el error (y los frames) de la última petición rechazada,
+# y las peticiones concurrentes se pisarían ese encadenado. Crearla cuesta mucho menos que el HMAC.
+CREDENTIALS_EXCEPTION_HEADERS = {"WWW-Authenticate": "Bearer"}
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers=CREDENTIALS_EXCEPTION_HEADERS,
+    )
+
 class TokenPayload(BaseModel):
+    # Inmutable: la misma instancia se comparte entre peticiones a través de la caché de tokens.
+    # extra="ignore": los claims que no usamos (app_metadata, user_metadata, iat, iss...) se
+    # descartan en vez de guardarse en cada payload cacheado.
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     sub: str             # User ID de Supabase (Subject)
     aud: str             # Audiencia, debería ser "authenticated"
     exp: int             # Tiempo de expiración (timestamp Unix)
@@ -31,42 +73,110 @@ class TokenPayload(BaseModel):
     # app_metadata: dict | None = None
     # user_metadata: dict | None = None
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> TokenPayload:
+# Validador construido una sola vez para el camino lento (payloads que no pasan la comprobación rápida).
+_token_validator = TypeAdapter(TokenPayload)
+
+# Caché de payloads ya verificados. Cada entrada vive como máximo TOKEN_CACHE_TTL_SECONDS o
+# hasta el 'exp' del token. En un acierto no se recalcula el HMAC ni se parsea el JSON:
+# solo se comprueba 'exp'.
+TOKEN_CACHE_TTL_SECONDS = 30
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL_SECONDS)
+# TTLCache no es thread-safe (cada lectura puede purgar entradas caducadas). Hoy se usa desde el
+# event loop, pero el lock la protege si la autenticación llega a ejecutarse en el threadpool.
+# Solo se toma para leer/escribir la caché, nunca durante la verificación del JWT.
+_token_cache_lock = threading.Lock()
+
+def _token_cache_key(token: str) -> bytes:
+    """
+    La clave es un hash del segmento de firma del JWT (nunca se guarda el token en claro).
+    La firma HS256 es única para cada cabecera+payload con nuestro secreto, y en un acierto se
+    devuelve el payload que esa firma autenticó, así que alterar el resto del token no sirve
+    para obtener otra identidad.
+    """
+    signature = token.rsplit(".", 1)[-1]
+    return hashlib.blake2b(signature.encode(), digest_size=16).digest()
+
+def _has_expected_claim_types(payload_dict: dict) -> bool:
+    """
+    True si los claims de TokenPayload tienen ya el tipo exacto del modelo (camino rápido).
+    """
+    exp = payload_dict.get("exp")
+    return (
+        isinstance(payload_dict.get("sub"), str)
+        and isinstance(payload_dict.get("aud"), str)
+        and isinstance(exp, int) and not isinstance(exp, bool)
+        and isinstance(payload_dict.get("email"), (str, type(None)))
+        and isinstance(payload_dict.get("role"), (str, type(None)))
+    )
+
+def _decode_and_validate(token: str) -> TokenPayload:
+    """
+    Devuelve el payload validado del token, usando la caché si ya se verificó hace poco.
+    Lanza JWTError o ValidationError si el token no es válido.
+    """
+    cache_key = _token_cache_key(token)
+    with _token_cache_lock:
+        cached_payload = _token_cache.get(cache_key)
+        if cached_payload is not None:
+            if cached_payload.exp > time.time():
+                return cached_payload
+            # El token ha expirado desde que se guardó: no se puede seguir sirviendo desde caché.
+            _token_cache.pop(cache_key, None)
+
+    payload_dict = _jwt_decoder.decode(
+        token,
+        _SECRET_BYTES,
+        algorithms=[ALGORITHM],
+        audience="authenticated",
+        options={"require": ["exp", "sub", "aud"]}
+    )
+    # jwt.decode ya ha verificado la firma, la audiencia y la expiración, así que el payload
+    # es de confianza y podemos saltarnos la validación completa de Pydantic.
+    # model_construct no convierte ni comprueba tipos, por eso _has_expected_claim_types revisa
+    # cada claim que usa TokenPayload; si alguno no tiene la forma esperada se usa la validación
+    # normal, que lanzará ValidationError (401) en vez de fallar después con un 500.
+    if _has_expected_claim_types(payload_dict):
+        token_data = TokenPayload.model_construct(**payload_dict)
+    else:
+        token_data = _token_validator.validate_python(payload_dict)
+
+    # Solo se cachea si al token le queda vida; la comprobación de 'exp' en cada acierto
+    # limita la entrada a min(TTL, exp - ahora).
+    if token_data.exp > time.time():
+        with _token_cache_lock:
+            _token_cache[cache_key] = token_data
+    return token_data
+
+def _authenticate(token: str) -> TokenPayload:
     """
     Decodifica y valida el token JWT.
     Devuelve el payload del token si es válido, o lanza HTTPException si no.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
     try:
-        payload_dict = jwt.decode(
-            token,
-            SUPABASE_JWT_SECRET,
-            algorithms=[ALGORITHM],
-            audience="authenticated"
-        )
-        # Valida la estructura del payload decodificado con el modelo Pydantic
-        token_data = TokenPayload(**payload_dict)
-
+        token_data = _decode_and_validate(token)
     except JWTError as e:
-        print(f"Error de JWT al decodificar/validar: {e}")
-        raise credentials_exception
+        logger.info("Error de JWT al decodificar/validar: %s", e)
+        raise _credentials_exception() from None
     except ValidationError as e:
-        print(f"Error de validación del payload del token: {e}")
-        raise credentials_exception
-    
-    if token_data.sub is None:
-        # Esta verificación es redundante si 'sub' es un campo obligatorio en TokenPayload,
-        # pero no hace daño como una doble comprobación.
-        raise credentials_exception
-        
+        logger.warning("Error de validación del payload del token: %s", e)
+        raise _credentials_exception() from None
+
+    # No hace falta comprobar 'sub' aquí: PyJWT lo exige como claim obligatorio y de tipo
+    # cadena, y el camino rápido de _decode_and_validate vuelve a comprobarlo.
     return token_data
 
-async def get_current_user_id(current_user: TokenPayload = Depends(get_current_user)) -> str:
+# Las dependencias se mantienen como 'async def' a propósito: no hacen ningún await, pero
+# FastAPI ejecuta las dependencias síncronas en el threadpool (run_in_threadpool), lo que
+# costaría un salto de hilo por petición en vez de una simple llamada en el event loop.
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> TokenPayload:
+    """
+    Dependencia que devuelve el payload completo del token JWT autenticado.
+    """
+    return _authenticate(token)
+
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
     """
     Dependencia de conveniencia que solo devuelve el ID del usuario (sub) del token.
+    Valida el token directamente, sin pasar por la dependencia get_current_user.
     """
-    return current_user.sub
\ No newline at end of file
+    return _authenticate(token).sub
\ No newline at end of file
@@ -0,0 +1,40 @@
+# my-english-corrector-backend/config.py
+import functools
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    """
+    Configuración de la aplicación leída de las variables de entorno (o del .env).
+    Los nombres de las variables son los de los campos en mayúsculas (DATABASE_URL, SQL_ECHO...).
+    Los valores obligatorios son Optional aquí: cada módulo comprueba los suyos al arrancar y
+    muestra su propio mensaje de error.
+    """
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    log_level: str = "INFO"
+
+    # --- Base de datos ---
+    database_url: Optional[str] = None
+    sql_echo: bool = False
+    db_pool_size: int = 20
+    db_max_overflow: int = 30
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
+    database_uses_pgbouncer: bool = False
+    run_migrations_on_startup: bool = False
+
+    # --- Supabase ---
+    supabase_url: Optional[str] = None
+    supabase_service_role_key: Optional[str] = None
+    supabase_jwt_secret: Optional[str] = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """
+    Retorna la configuración, parseada una sola vez por proceso.
+    """
+    return Settings()
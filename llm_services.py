@@ -1,9 +1,19 @@
 # my-english-corrector-backend/llm_services.py
 import os
+import io
+import asyncio
+import logging
+import binascii
+import hashlib
+import functools
+from typing import AsyncIterator
+import httpx
+import orjson
+from cachetools import TTLCache
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
 from pydantic import SecretStr
 from prompts import (
     VISION_TRANSCRIPTION_PROMPT,
@@ -13,8 +23,32 @@ from prompts import (
 
 load_dotenv() # Asegurarse de que las variables de entorno estén cargadas
 
+logger = logging.getLogger(__name__)
+
+
+class _LazyTruncate:
+    """Recorta el texto solo cuando el handler de logging lo formatea de verdad."""
+    __slots__ = ("text", "limit")
+
+    def __init__(self, text: str, limit: int):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self) -> str:
+        return self.text[:self.limit]
+
+
+def lazy_truncate(text: str, limit: int) -> _LazyTruncate:
+    """
+    Envuelve un texto para usarlo como argumento de logger.debug("... %s", ...): el recorte
+    (y la copia de la cadena) no se hace si el nivel de log no lo va a emitir.
+    """
+    return _LazyTruncate(text, limit)
+
 # Configuración de API Keys
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# La key de OpenAI se envuelve en SecretStr una sola vez y se comparte entre los clientes.
+_OPENAI_API_SECRET = SecretStr(OPENAI_API_KEY) if OPENAI_API_KEY else None
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 # --- Configuración de Modelos de VISIÓN ---
@@ -26,59 +60,368 @@ GOOGLE_VISION_MODEL_NAME = os.getenv("GOOGLE_VISION_MODEL_NAME", "gemini-1.5-fla
 DEFAULT_LANGUAGE_MODEL_PROVIDER = os.getenv("DEFAULT_LANGUAGE_MODEL_PROVIDER", "OPENAI")
 OPENAI_LANGUAGE_MODEL_NAME = os.getenv("OPENAI_LANGUAGE_MODEL_NAME", "gpt-4o")
 GOOGLE_LANGUAGE_MODEL_NAME = os.getenv("GOOGLE_LANGUAGE_MODEL_NAME", "gemini-1.5-pro-latest")
+# Con OpenAI, las redacciones cortas (menos de SHORT_ESSAY_WORD_THRESHOLD palabras) se corrigen
+# con un modelo más pequeño: dan la misma calidad de feedback en mucho menos tiempo y coste.
+# Con 0 se desactiva y todo va al modelo principal.
+OPENAI_SHORT_ESSAY_MODEL_NAME = os.getenv("OPENAI_SHORT_ESSAY_MODEL_NAME", "gpt-4o-mini")
+SHORT_ESSAY_WORD_THRESHOLD = int(os.getenv("SHORT_ESSAY_WORD_THRESHOLD", "150"))
+
+LANGUAGE_MODEL_NAMES = {
+    "OPENAI": OPENAI_LANGUAGE_MODEL_NAME,
+    "OPENAI_MINI": OPENAI_SHORT_ESSAY_MODEL_NAME,
+    "GOOGLE": GOOGLE_LANGUAGE_MODEL_NAME,
+}
+
+
+def _select_language_provider(text_to_correct: str) -> str:
+    """
+    Elige el proveedor de lenguaje para un texto: el modelo pequeño de OpenAI para las
+    redacciones cortas y DEFAULT_LANGUAGE_MODEL_PROVIDER para el resto.
+    """
+    if (
+        DEFAULT_LANGUAGE_MODEL_PROVIDER == "OPENAI"
+        and SHORT_ESSAY_WORD_THRESHOLD > 0
+        and len(text_to_correct.split()) < SHORT_ESSAY_WORD_THRESHOLD
+    ):
+        return "OPENAI_MINI"
+    return DEFAULT_LANGUAGE_MODEL_PROVIDER
 
 # --- Versión del Prompt de Corrección ---
 CORRECTION_PROMPT_VERSION_CURRENT = PROMPT_VERSION
 
+# Plantilla de corrección compilada una sola vez: el esquema de mensajes ya queda validado y
+# en cada petición solo se rellena {text}.
+_CORRECTION_TEMPLATE = ChatPromptTemplate.from_messages(
+    [("system", CORRECTION_SYSTEM_PROMPT), ("human", "{text}")]
+)
+
+# OpenAI solo cachea automáticamente prefijos de al menos 1024 tokens.
+OPENAI_PROMPT_CACHE_MIN_TOKENS = 1024
 
-def get_vision_model_client():
+
+@functools.lru_cache(maxsize=None)
+def correction_system_prompt_token_count() -> int:
+    """
+    Retorna el número de tokens del prompt de sistema de corrección con el tokenizador del
+    modelo de OpenAI. Se calcula una sola vez (el prompt no cambia sin subir PROMPT_VERSION);
+    tiktoken se importa aquí para no cargarlo en despliegues que no lo usan.
+    """
+    import tiktoken
+    try:
+        encoding = tiktoken.encoding_for_model(OPENAI_LANGUAGE_MODEL_NAME)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return len(encoding.encode(CORRECTION_SYSTEM_PROMPT))
+
+
+def log_correction_prompt_token_count() -> None:
+    """
+    Deja en el log el tamaño del prompt de corrección y si alcanza el mínimo para el caché de
+    prompts de OpenAI. Es solo informativo: cualquier fallo (p. ej. sin red para descargar el
+    tokenizador) se registra y se ignora.
+    """
+    if DEFAULT_LANGUAGE_MODEL_PROVIDER != "OPENAI":
+        return
+    try:
+        token_count = correction_system_prompt_token_count()
+    except Exception as e:
+        logger.warning("No se pudo contar los tokens del prompt de corrección: %s", e)
+        return
+    if token_count >= OPENAI_PROMPT_CACHE_MIN_TOKENS:
+        logger.info("Prompt de corrección v%s: %d tokens (entra en el caché de prompts de OpenAI).",
+                    CORRECTION_PROMPT_VERSION_CURRENT, token_count)
+    else:
+        logger.info("Prompt de corrección v%s: %d tokens (por debajo de los %d que necesita el caché de prompts de OpenAI).",
+                    CORRECTION_PROMPT_VERSION_CURRENT, token_count, OPENAI_PROMPT_CACHE_MIN_TOKENS)
+
+
+# --- Caché de correcciones ---
+# Los alumnos reenvían a menudo el mismo texto; si ya se corrigió con la misma versión del
+# prompt y el mismo modelo se devuelve el feedback guardado sin volver a llamar al LLM.
+_correction_cache: TTLCache = TTLCache(maxsize=2000, ttl=3600)
+
+
+def _correction_cache_key(text_to_correct: str, provider: str) -> str:
+    model_name = LANGUAGE_MODEL_NAMES.get(provider, provider)
+    return hashlib.sha256(
+        orjson.dumps({"v": CORRECTION_PROMPT_VERSION_CURRENT, "m": model_name, "t": text_to_correct})
+    ).hexdigest()
+
+
+def _is_primary_model_answer(answered_model_name: str | None, provider: str) -> bool:
+    """
+    True si la respuesta la generó el modelo del proveedor pedido y no el de respaldo
+    (with_fallbacks no lo indica de otra forma). Se compara con el 'model_name' que los clientes
+    dejan en response_metadata; el proveedor devuelve a veces la versión concreta
+    ("gpt-4o-mini-2024-07-18" para "gpt-4o-mini"). Sin ese dato se asume que no es del principal:
+    la clave de caché es la del modelo principal y solo debe guardar respuestas suyas.
+    """
+    if not answered_model_name:
+        return False
+    expected_model_name = LANGUAGE_MODEL_NAMES.get(provider, provider).removeprefix("models/").removesuffix("-latest")
+    return answered_model_name.removeprefix("models/").startswith(expected_model_name)
+
+
+# --- Cliente HTTP compartido ---
+# Un único httpx.AsyncClient por proceso para que las conexiones TCP/TLS (y HTTP/2) con los
+# proveedores se reutilicen entre peticiones en lugar de abrirse de nuevo en cada llamada.
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = 32
+LLM_HTTP_MAX_CONNECTIONS = 64
+# Las conexiones inactivas se mantienen 90 s: entre dos correcciones seguidas de un mismo
+# profesor no hace falta repetir el handshake TLS.
+LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS = 90
+# Una corrección larga puede tardar bastante en generarse; el timeout por defecto de httpx (5 s)
+# la cortaría.
+LLM_HTTP_TIMEOUT_SECONDS = 120
+_shared_http_client: httpx.AsyncClient | None = None
+
+
+def get_shared_http_client() -> httpx.AsyncClient:
+    """
+    Retorna el httpx.AsyncClient compartido por el proceso, creándolo la primera vez.
+    """
+    global _shared_http_client
+    if _shared_http_client is None:
+        _shared_http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=LLM_HTTP_TIMEOUT_SECONDS,
+        )
+    return _shared_http_client
+
+
+# Solo los clientes de OpenAI usan el httpx.AsyncClient compartido; el SDK de Google gestiona
+# sus propias conexiones, así que precalentarlas desde aquí no serviría de nada.
+OPENAI_PREWARM_URL = "https://api.openai.com/v1/models"
+PREWARM_TIMEOUT_SECONDS = 5
+
+
+async def prewarm_llm_connections() -> None:
+    """
+    Abre por adelantado (DNS + TCP + TLS) la conexión con OpenAI si alguno de los modelos
+    configurados la usa, para que la primera petición de un usuario no pague ese coste.
+    Cualquier fallo se ignora: la conexión se abrirá igualmente en la primera llamada real.
+    """
+    uses_openai = DEFAULT_VISION_MODEL_PROVIDER == "GPT4O_MINI" or DEFAULT_LANGUAGE_MODEL_PROVIDER == "OPENAI"
+    if not uses_openai or not OPENAI_API_KEY:
+        return
+    try:
+        await get_shared_http_client().head(OPENAI_PREWARM_URL, timeout=PREWARM_TIMEOUT_SECONDS)
+        logger.info("Conexión con OpenAI precalentada.")
+    except httpx.HTTPError as e:
+        logger.warning("No se pudo precalentar la conexión con OpenAI: %s", e)
+
+
+async def close_shared_http_client() -> None:
+    """
+    Cierra el httpx.AsyncClient compartido (y sus conexiones abiertas). Se llama al apagar la
+    aplicación; atexit no sirve aquí porque el cierre es asíncrono y necesita el event loop.
+    También vacía las cachés de clientes y cadenas, que guardan una referencia al cliente cerrado:
+    si se vuelven a usar (otro arranque de la app en el mismo proceso, tests) se crean de nuevo con
+    un cliente HTTP nuevo.
+    """
+    global _shared_http_client
+    get_correction_chain.cache_clear()
+    get_language_model_client.cache_clear()
+    get_vision_model_client.cache_clear()
+    if _shared_http_client is not None:
+        await _shared_http_client.aclose()
+        _shared_http_client = None
+
+
+# Los clientes LLM se construyen una sola vez por proveedor (validación de la API key,
+# cliente HTTP, etc.) y se reutilizan en todas las peticiones.
+# Los paquetes de cada proveedor se importan dentro de su rama: cada uno arrastra un árbol de
+# dependencias muy pesado (tiktoken, openai / google-auth, grpcio, protobuf) y en cada
+# despliegue solo se usa uno.
+@functools.lru_cache(maxsize=None)
+def get_vision_model_client(provider: str = DEFAULT_VISION_MODEL_PROVIDER):
     """
     Retorna una instancia del cliente LLM de visión configurado
-    basado en DEFAULT_VISION_MODEL_PROVIDER.
+    basado en DEFAULT_VISION_MODEL_PROVIDER (o en el proveedor indicado).
     """
-    if DEFAULT_VISION_MODEL_PROVIDER == "GEMINI_FLASH":
+    if provider == "GEMINI_FLASH":
         if not GOOGLE_API_KEY:
             raise ValueError("GOOGLE_API_KEY no está configurada para el modelo de visión de Google.")
-        print(f"Usando modelo de visión de Google: {GOOGLE_VISION_MODEL_NAME}")
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        logger.info("Usando modelo de visión de Google: %s", GOOGLE_VISION_MODEL_NAME)
         return ChatGoogleGenerativeAI(model=GOOGLE_VISION_MODEL_NAME, google_api_key=GOOGLE_API_KEY)
     
-    elif DEFAULT_VISION_MODEL_PROVIDER == "GPT4O_MINI": 
+    elif provider == "GPT4O_MINI": 
         if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY no está configurada para el modelo de visión de OpenAI.")
-        print(f"Usando modelo de visión de OpenAI: {OPENAI_VISION_MODEL_NAME}")
-        return ChatOpenAI(model=OPENAI_VISION_MODEL_NAME, api_key=SecretStr(OPENAI_API_KEY))
+        from langchain_openai import ChatOpenAI
+        logger.info("Usando modelo de visión de OpenAI: %s", OPENAI_VISION_MODEL_NAME)
+        return ChatOpenAI(model=OPENAI_VISION_MODEL_NAME, api_key=_OPENAI_API_SECRET,
+                          http_async_client=get_shared_http_client())
     
     else:
-        raise ValueError(f"Proveedor de modelo de visión no soportado: {DEFAULT_VISION_MODEL_PROVIDER}")
+        raise ValueError(f"Proveedor de modelo de visión no soportado: {provider}")
 
 
-def get_language_model_client():
+@functools.lru_cache(maxsize=None)
+def get_language_model_client(provider: str = DEFAULT_LANGUAGE_MODEL_PROVIDER):
     """
     Retorna una instancia del cliente LLM de lenguaje configurado
-    basado en DEFAULT_LANGUAGE_MODEL_PROVIDER.
+    basado en DEFAULT_LANGUAGE_MODEL_PROVIDER (o en el proveedor indicado).
     """
-    if DEFAULT_LANGUAGE_MODEL_PROVIDER == "GOOGLE":
+    if provider == "GOOGLE":
         if not GOOGLE_API_KEY:
             raise ValueError("GOOGLE_API_KEY no está configurada para el modelo de lenguaje de Google.")
-        print(f"Usando modelo de lenguaje de Google: {GOOGLE_LANGUAGE_MODEL_NAME}")
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        logger.info("Usando modelo de lenguaje de Google: %s", GOOGLE_LANGUAGE_MODEL_NAME)
         return ChatGoogleGenerativeAI(model=GOOGLE_LANGUAGE_MODEL_NAME, google_api_key=GOOGLE_API_KEY,
                                       temperature=0.3, top_p=0.9)
     
-    elif DEFAULT_LANGUAGE_MODEL_PROVIDER == "OPENAI":
+    elif provider in ("OPENAI", "OPENAI_MINI"):
         if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY no está configurada para el modelo de lenguaje de OpenAI.")
-        print(f"Usando modelo de lenguaje de OpenAI: {OPENAI_LANGUAGE_MODEL_NAME}")
-        return ChatOpenAI(model=OPENAI_LANGUAGE_MODEL_NAME, api_key=SecretStr(OPENAI_API_KEY),
-                          temperature=0.3, top_p=0.9)
+        from langchain_openai import ChatOpenAI
+        model_name = LANGUAGE_MODEL_NAMES[provider]
+        logger.info("Usando modelo de lenguaje de OpenAI: %s", model_name)
+        # El prompt de sistema es idéntico en todas las correcciones; con una prompt_cache_key
+        # estable OpenAI enruta las peticiones al mismo caché de prefijo (mientras sea de la
+        # misma versión del prompt).
+        return ChatOpenAI(model=model_name, api_key=_OPENAI_API_SECRET,
+                          temperature=0.3, top_p=0.9, http_async_client=get_shared_http_client(),
+                          extra_body={"prompt_cache_key": f"corrector-v{CORRECTION_PROMPT_VERSION_CURRENT}"})
     
     else:
-        raise ValueError(f"Proveedor de modelo de lenguaje no soportado: {DEFAULT_LANGUAGE_MODEL_PROVIDER}")
+        raise ValueError(f"Proveedor de modelo de lenguaje no soportado: {provider}")
+
+
+# Reintentos (con backoff exponencial y jitter) ante errores del proveedor principal antes de
+# pasar al proveedor de respaldo.
+CORRECTION_RETRY_ATTEMPTS = 3
+
+
+def _fallback_language_provider(provider: str) -> str | None:
+    """
+    Retorna el proveedor de respaldo para correcciones (el otro proveedor, si tiene API key).
+    """
+    if provider in ("OPENAI", "OPENAI_MINI"):
+        return "GOOGLE" if GOOGLE_API_KEY else None
+    if provider == "GOOGLE":
+        return "OPENAI" if OPENAI_API_KEY else None
+    return None
+
 
+@functools.lru_cache(maxsize=None)
+def get_correction_chain(provider: str = DEFAULT_LANGUAGE_MODEL_PROVIDER):
+    """
+    Retorna la cadena plantilla de corrección | cliente LLM de lenguaje del proveedor indicado.
+    Se construye la primera vez que se usa (y no al importar) para no exigir la API key al arrancar.
+    El cliente se reintenta ante errores transitorios (429/5xx) y, si el otro proveedor está
+    configurado, se recurre a él cuando los reintentos se agotan.
+    """
+    llm = get_language_model_client(provider).with_retry(
+        stop_after_attempt=CORRECTION_RETRY_ATTEMPTS, wait_exponential_jitter=True
+    )
+    fallback_provider = _fallback_language_provider(provider)
+    if fallback_provider is not None:
+        logger.info("Proveedor de respaldo para correcciones con %s: %s", provider, fallback_provider)
+        llm = llm.with_fallbacks([get_language_model_client(fallback_provider)])
+    return _CORRECTION_TEMPLATE | llm
+
+
+# --- Preparación de imágenes para el LLM de visión ---
+IMAGE_FETCH_TIMEOUT_SECONDS = 10
+JPEG_REENCODE_QUALITY = 88
+# Lado máximo enviado al LLM: las fotos de móvil (3000x4000 px) se reducen a este tamaño.
+MAX_IMAGE_DIMENSION = 2048
+# Hasta este tamaño el modo "low" de OpenAI (que trabaja a 512 px) no pierde detalle y
+# consume muchos menos tokens de imagen; por encima se pide "high" para no perder legibilidad.
+LOW_DETAIL_MAX_DIMENSION = 512
+
+
+def _prepare_image_for_llm(image_bytes: bytes, content_type: str | None) -> tuple[bytes, str, int]:
+    """
+    Reduce la imagen a MAX_IMAGE_DIMENSION y la recodifica como JPEG cuando es demasiado
+    grande o es un PNG. Retorna (bytes, mime_type, lado_mayor_en_px).
+    Las imágenes ya pequeñas en otros formatos se devuelven sin tocar.
+    """
+    mime_type = (content_type or "image/jpeg").split(";")[0].strip().lower()
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        max_dimension = max(img.size)
+        if max_dimension <= MAX_IMAGE_DIMENSION and mime_type != "image/png":
+            return image_bytes, mime_type, max_dimension
+        # Aplicar la orientación EXIF antes de recodificar, ya que el JPEG resultante no la conserva.
+        processed = ImageOps.exif_transpose(img).convert("RGB")
+        processed.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        processed.save(output, format="JPEG", quality=JPEG_REENCODE_QUALITY)
+        return output.getvalue(), "image/jpeg", max(processed.size)
 
-async def transcribe_image_url_with_llm(image_url: str, prompt_text: str | None = None) -> str:
+
+def _build_image_payload(image_bytes: bytes, content_type: str | None) -> dict:
+    """
+    Construye el bloque 'image_url' con la imagen en línea (data URL en base64), para que el
+    proveedor no tenga que descargarla por su cuenta desde el almacenamiento.
+    """
+    mime_type = (content_type or "image/jpeg").split(";")[0].strip().lower()
+    max_dimension: int | None = None
+    try:
+        image_bytes, mime_type, max_dimension = _prepare_image_for_llm(image_bytes, content_type)
+    except Exception as e:
+        logger.warning("No se pudo reducir/recodificar la imagen, se envía la original: %s", e)
+    # b2a_base64 escribe directamente el base64 de los bytes; el prefijo se une en bytes y la
+    # cadena final se decodifica una sola vez (una copia grande menos por imagen).
+    data_url = b"".join((f"data:{mime_type};base64,".encode(), binascii.b2a_base64(image_bytes, newline=False)))
+    image_payload = {"url": data_url.decode("ascii")}
+    if max_dimension is not None:
+        image_payload["detail"] = "high" if max_dimension > LOW_DETAIL_MAX_DIMENSION else "low"
+    return image_payload
+
+
+def _message_text(message: BaseMessage) -> str:
+    """
+    Retorna el texto de un mensaje del LLM. Los modelos de chat devuelven casi siempre un str
+    y se usa tal cual; si llega una lista de bloques (Gemini puede hacerlo) se concatenan sus
+    partes de texto en lugar de hacer str() sobre la lista.
+    """
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return message.text()
+
+
+# --- Caché de transcripciones ---
+# Volver a subir la misma foto (o re-transcribir un ensayo) no vuelve a pasar por el LLM de
+# visión: la clave es el hash de los bytes de la imagen, del prompt y del modelo.
+_transcription_cache: TTLCache = TTLCache(maxsize=500, ttl=3600)
+
+
+def _transcription_cache_key(image_bytes: bytes, prompt_text: str) -> str:
+    model_name = OPENAI_VISION_MODEL_NAME if DEFAULT_VISION_MODEL_PROVIDER == "GPT4O_MINI" else GOOGLE_VISION_MODEL_NAME
+    hasher = hashlib.sha256(orjson.dumps({"m": model_name, "p": prompt_text}))
+    hasher.update(image_bytes)
+    return hasher.hexdigest()
+
+
+async def _fetch_image_bytes(image_url: str) -> tuple[bytes, str | None]:
+    """
+    Descarga la imagen con el cliente HTTP compartido. Retorna (bytes, content-type).
+    """
+    response = await get_shared_http_client().get(image_url, timeout=IMAGE_FETCH_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.content, response.headers.get("content-type")
+
+
+async def transcribe_image_url_with_llm(
+    image_url: str,
+    prompt_text: str | None = None,
+    image_bytes: bytes | None = None,
+    image_content_type: str | None = None,
+) -> str:
     """
     Toma una URL de imagen y un prompt, y usa el LLM de visión configurado
     para obtener una transcripción o descripción.
+    La imagen se descarga en el backend, se reduce si es muy grande y se envía en línea
+    (base64); si ya se tienen los bytes se pueden pasar en image_bytes para evitar la descarga.
     El LLM NO debe corregir errores gramaticales o de ortografía, solo transcribir.
     La transcripción DEBE estar en el mismo idioma que el texto manuscrito (asumido inglés).
     """
@@ -87,90 +430,190 @@ async def transcribe_image_url_with_llm(image_url: str, prompt_text: str | None
     if prompt_text is None:
         prompt_text = VISION_TRANSCRIPTION_PROMPT
 
+    image_payload = {"url": image_url}
+    cache_key = None
+    if image_bytes is None:
+        try:
+            image_bytes, image_content_type = await _fetch_image_bytes(image_url)
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            # Si la descarga falla, el proveedor puede seguir intentándolo con la URL original.
+            logger.warning("No se pudo descargar la imagen %s, se envía la URL al LLM: %s", image_url, e)
+    if image_bytes is not None:
+        cache_key = _transcription_cache_key(image_bytes, prompt_text)
+        cached_transcription = _transcription_cache.get(cache_key)
+        if cached_transcription is not None:
+            logger.info("Transcripción de la imagen %s servida desde caché.", image_url)
+            return cached_transcription
+        # Decodificar, reducir y recodificar con Pillow (y pasar a base64) es trabajo de CPU de
+        # decenas de ms por página: va a un hilo para no bloquear el event loop (Pillow libera el
+        # GIL, así que las páginas que se transcriben a la vez se procesan en paralelo).
+        # Los errores de Pillow ya los resuelve _build_image_payload (envía la imagen original).
+        try:
+            image_payload = await asyncio.to_thread(_build_image_payload, image_bytes, image_content_type)
+        except Exception as e:
+            logger.error("No se pudo preparar la imagen %s para el LLM (%s), se envía su URL: %s",
+                         image_url, type(e).__name__, e)
+
     message_content = [
         {"type": "text", "text": prompt_text},
-        {"type": "image_url", "image_url": {"url": image_url}},
+        {"type": "image_url", "image_url": image_payload},
     ]
     human_message = HumanMessage(content=message_content)
     
-    print(f"Enviando imagen {image_url} y prompt de transcripción al LLM...")
+    logger.info("Enviando imagen %s y prompt de transcripción al LLM...", image_url)
     # ... (resto de la función igual que antes) ...
     try:
         ai_response = await llm.ainvoke([human_message]) 
-        transcription = str(ai_response.content) if ai_response.content else ""
-        print("LLM Transcription Response Content (first 300 chars):", transcription[:300])
+        transcription = _message_text(ai_response)
+        logger.debug("LLM Transcription Response Content (first 300 chars): %s", lazy_truncate(transcription, 300))
+        if cache_key is not None and transcription.strip():
+            _transcription_cache[cache_key] = transcription
         return transcription
     except Exception as e:
-        print(f"Error al llamar al LLM de visión para transcripción: {e}")
+        logger.error("Error al llamar al LLM de visión para transcripción: %s", e)
         raise
 
+# Correcciones en curso por clave de caché: si llega el mismo texto mientras su corrección
+# todavía se está generando (doble clic, reintento del cliente), se espera a esa misma llamada
+# en lugar de lanzar otra idéntica al LLM.
+_inflight_corrections: dict[str, asyncio.Task] = {}
+
+
 async def correct_text_with_llm(text_to_correct: str, student_level: str = "intermediate") -> str:
     """
     Toma un texto (la redacción transcrita) y usa el LLM de lenguaje configurado
     para obtener una corrección y feedback.
+    Si el mismo texto ya se corrigió con la versión actual del prompt, se devuelve el
+    feedback cacheado; si se está corrigiendo en ese momento, se reutiliza esa llamada.
     """
-    llm = get_language_model_client()
-    
-    messages = [
-        SystemMessage(content=CORRECTION_SYSTEM_PROMPT.strip()),
-        HumanMessage(content=text_to_correct)
-    ]
-    
-    provider_name = DEFAULT_LANGUAGE_MODEL_PROVIDER
-    model_name = OPENAI_LANGUAGE_MODEL_NAME if provider_name == 'OPENAI' else GOOGLE_LANGUAGE_MODEL_NAME
-    print(f"Enviando texto para corrección al LLM (Proveedor: {provider_name}, Modelo: {model_name})...")
+    provider = _select_language_provider(text_to_correct)
+    cache_key = _correction_cache_key(text_to_correct, provider)
+    cached_feedback = _correction_cache.get(cache_key)
+    if cached_feedback is not None:
+        logger.info("Corrección servida desde caché.")
+        return cached_feedback
+
+    task = _inflight_corrections.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_invoke_correction(text_to_correct, provider, cache_key))
+        _inflight_corrections[cache_key] = task
+        task.add_done_callback(functools.partial(_forget_inflight_correction, cache_key))
+    else:
+        logger.info("Corrección idéntica en curso; se reutiliza su resultado.")
+    # shield: si se cancela una de las peticiones que esperan, la llamada al LLM sigue
+    # adelante para las demás.
+    return await asyncio.shield(task)
+
+
+def _forget_inflight_correction(cache_key: str, task: asyncio.Task) -> None:
+    """
+    Al terminar la llamada compartida: la quita de las correcciones en curso y recupera su
+    excepción. Si todas las peticiones que la esperaban se cancelaron nadie la lee, y asyncio
+    avisaría con "Task exception was never retrieved"; el error ya lo registra _invoke_correction.
+    """
+    if _inflight_corrections.get(cache_key) is task:
+        del _inflight_corrections[cache_key]
+    if not task.cancelled():
+        task.exception()
+
+
+async def _invoke_correction(text_to_correct: str, provider: str, cache_key: str) -> str:
+    chain = get_correction_chain(provider)
+
+    logger.info("Enviando texto para corrección al LLM (Proveedor: %s, Modelo: %s)...", provider, LANGUAGE_MODEL_NAMES.get(provider))
     try:
-        ai_response = await llm.ainvoke(messages)
-        correction_feedback = str(ai_response.content) if ai_response.content else ""
-        print("LLM Correction Response Content (first 500 chars):", correction_feedback[:500] + "...")
+        ai_response = await chain.ainvoke({"text": text_to_correct})
+        correction_feedback = _message_text(ai_response)
+        logger.debug("LLM Correction Response Content (first 500 chars): %s...", lazy_truncate(correction_feedback, 500))
+        if correction_feedback.strip() and _is_primary_model_answer(ai_response.response_metadata.get("model_name"), provider):
+            _correction_cache[cache_key] = correction_feedback
         return correction_feedback
     except Exception as e:
-        print(f"Error al llamar al LLM de lenguaje para corrección: {e}")
+        logger.error("Error al llamar al LLM de lenguaje para corrección: %s", e)
         raise
 
 
-# --- EJEMPLO DE PRUEBA (Puedes ejecutar este archivo directamente para probar) ---
-if __name__ == "__main__":
-    import asyncio
-    
-    test_student_text_example = """
-    Hello teacher, my name is John. I want tell you about my holiday.
-    Last summer, I goed to the beach with my family. It were very fun.
-    The sun shined and the water are blue. We swimmed and play volleyball.
-    I eated many ice cream. My brother, he falled down when play.
-    I think vacations is very important for relax. I like so much my holiday.
-    Thank for reading.
-    """
-
-    async def main_test():
-        # --- Prueba de Transcripción ---
-        # Necesitarás una URL de imagen real y accesible para que esto funcione.
-        # test_image_url = "PON_AQUI_UNA_URL_DE_IMAGEN_MANUSCRITA_REAL" 
-        # if test_image_url and test_image_url != "PON_AQUI_UNA_URL_DE_IMAGEN_MANUSCRITA_REAL":
-        #     print(f"Probando TRANSCRIPCIÓN con el proveedor por defecto: {DEFAULT_VISION_MODEL_PROVIDER}")
-        #     try:
-        #         transcription = await transcribe_image_url_with_llm(test_image_url) 
-        #         print("\n--- Transcripción Obtenida ---")
-        #         print(transcription)
-        #     except ValueError as ve:
-        #         print(f"Error de configuración (Visión): {ve}")
-        #     except Exception as e:
-        #         print(f"Ocurrió un error durante la prueba de visión: {e}")
-        # else:
-        #     print("INFO: Prueba de transcripción omitida, no se proporcionó test_image_url.")
-
-        print("\n" + "="*50 + "\n")
-
-        # --- Prueba de Corrección ---
-        print(f"Probando CORRECCIÓN con el proveedor por defecto: {DEFAULT_LANGUAGE_MODEL_PROVIDER}")
+# Máximo de correcciones simultáneas que se lanzan al proveedor desde un mismo lote.
+CORRECTION_BATCH_MAX_CONCURRENCY = 8
+
+
+async def correct_texts_batch(texts: list[str]) -> list[str]:
+    """
+    Corrige varias redacciones de una vez con abatch sobre la cadena de corrección, reutilizando el mismo cliente (y sus
+    conexiones) para todas. Los textos que ya están en la caché de correcciones no se envían.
+    Cada texto va al modelo que le corresponde por longitud (un abatch por proveedor), y los
+    textos repetidos dentro del lote se envían una sola vez.
+    Retorna los feedbacks en el mismo orden que los textos recibidos.
+    """
+    results: list[str | None] = []
+    # Proveedor -> clave de caché -> posiciones de los textos con esa clave.
+    pending_by_provider: dict[str, dict[str, list[int]]] = {}
+    for index, text in enumerate(texts):
+        provider = _select_language_provider(text)
+        cache_key = _correction_cache_key(text, provider)
+        cached_feedback = _correction_cache.get(cache_key)
+        results.append(cached_feedback)
+        if cached_feedback is None:
+            pending_by_provider.setdefault(provider, {}).setdefault(cache_key, []).append(index)
+
+    async def run_provider_batch(provider: str, indexes_by_key: dict[str, list[int]]) -> None:
+        logger.info("Enviando lote de %d textos para corrección al LLM (Proveedor: %s)...", len(indexes_by_key), provider)
+        ai_responses = await get_correction_chain(provider).abatch(
+            [{"text": texts[indexes[0]]} for indexes in indexes_by_key.values()],
+            config={"max_concurrency": CORRECTION_BATCH_MAX_CONCURRENCY},
+        )
+        for (cache_key, indexes), ai_response in zip(indexes_by_key.items(), ai_responses):
+            correction_feedback = _message_text(ai_response)
+            if correction_feedback.strip() and _is_primary_model_answer(ai_response.response_metadata.get("model_name"), provider):
+                _correction_cache[cache_key] = correction_feedback
+            for index in indexes:
+                results[index] = correction_feedback
+
+    if pending_by_provider:
         try:
-            feedback = await correct_text_with_llm(test_student_text_example)
-            print("\n--- Feedback de Corrección Obtenido ---")
-            print(feedback)
-            print(f"\n(Versión del prompt de corrección usado: {CORRECTION_PROMPT_VERSION_CURRENT})")
-        except ValueError as ve:
-            print(f"Error de configuración (Lenguaje): {ve}")
+            await asyncio.gather(*(
+                run_provider_batch(provider, indexes_by_key)
+                for provider, indexes_by_key in pending_by_provider.items()
+            ))
         except Exception as e:
-            print(f"Ocurrió un error durante la prueba de lenguaje: {e}")
+            logger.error("Error al llamar al LLM de lenguaje para corrección en lote: %s", e)
+            raise
+
+    return [feedback or "" for feedback in results]
+
 
-    asyncio.run(main_test())
\ No newline at end of file
+async def stream_correct_text_with_llm(text_to_correct: str) -> AsyncIterator[str]:
+    """
+    Igual que correct_text_with_llm, pero va devolviendo el feedback por fragmentos a medida
+    que el LLM lo genera (astream), para poder enviarlo al cliente sin esperar al final.
+    Comparte la caché de correcciones con correct_text_with_llm: un texto ya corregido se
+    devuelve en un solo fragmento y un streaming completo del modelo principal deja su feedback cacheado.
+    """
+    provider = _select_language_provider(text_to_correct)
+    cache_key = _correction_cache_key(text_to_correct, provider)
+    cached_feedback = _correction_cache.get(cache_key)
+    if cached_feedback is not None:
+        logger.info("Corrección (streaming) servida desde caché.")
+        yield cached_feedback
+        return
+
+    chain = get_correction_chain(provider)
+
+    logger.info("Enviando texto para corrección en streaming al LLM (Proveedor: %s, Modelo: %s)...", provider, LANGUAGE_MODEL_NAMES.get(provider))
+    feedback_parts: list[str] = []
+    # Los proveedores indican el modelo en alguno de los fragmentos (normalmente el último).
+    answered_model_name: str | None = None
+    try:
+        async for chunk in chain.astream({"text": text_to_correct}):
+            answered_model_name = chunk.response_metadata.get("model_name") or answered_model_name
+            chunk_text = _message_text(chunk)
+            if chunk_text:
+                feedback_parts.append(chunk_text)
+                yield chunk_text
+    except Exception as e:
+        logger.error("Error al llamar al LLM de lenguaje para corrección (streaming): %s", e)
+        raise
+    correction_feedback = "".join(feedback_parts)
+    logger.debug("LLM Correction Response Content (first 500 chars): %s...", lazy_truncate(correction_feedback, 500))
+    if correction_feedback.strip() and _is_primary_model_answer(answered_model_name, provider):
+        _correction_cache[cache_key] = correction_feedback
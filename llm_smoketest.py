@@ -0,0 +1,57 @@
+# my-english-corrector-backend/llm_smoketest.py
+# Prueba manual de los servicios LLM contra los proveedores reales (usa las API keys del .env).
+# Ejecutar con: python llm_smoketest.py
+import asyncio
+
+from llm_services import (
+    CORRECTION_PROMPT_VERSION_CURRENT,
+    DEFAULT_LANGUAGE_MODEL_PROVIDER,
+    DEFAULT_VISION_MODEL_PROVIDER,
+    correct_text_with_llm,
+    transcribe_image_url_with_llm,
+)
+
+test_student_text_example = """
+Hello teacher, my name is John. I want tell you about my holiday.
+Last summer, I goed to the beach with my family. It were very fun.
+The sun shined and the water are blue. We swimmed and play volleyball.
+I eated many ice cream. My brother, he falled down when play.
+I think vacations is very important for relax. I like so much my holiday.
+Thank for reading.
+"""
+
+
+async def main_test():
+    # --- Prueba de Transcripción ---
+    # Necesitarás una URL de imagen real y accesible para que esto funcione.
+    # test_image_url = "PON_AQUI_UNA_URL_DE_IMAGEN_MANUSCRITA_REAL" 
+    # if test_image_url and test_image_url != "PON_AQUI_UNA_URL_DE_IMAGEN_MANUSCRITA_REAL":
+    #     print(f"Probando TRANSCRIPCIÓN con el proveedor por defecto: {DEFAULT_VISION_MODEL_PROVIDER}")
+    #     try:
+    #         transcription = await transcribe_image_url_with_llm(test_image_url) 
+    #         print("\n--- Transcripción Obtenida ---")
+    #         print(transcription)
+    #     except ValueError as ve:
+    #         print(f"Error de configuración (Visión): {ve}")
+    #     except Exception as e:
+    #         print(f"Ocurrió un error durante la prueba de visión: {e}")
+    # else:
+    #     print("INFO: Prueba de transcripción omitida, no se proporcionó test_image_url.")
+
+    print("\n" + "="*50 + "\n")
+
+    # --- Prueba de Corrección ---
+    print(f"Probando CORRECCIÓN con el proveedor por defecto: {DEFAULT_LANGUAGE_MODEL_PROVIDER}")
+    try:
+        feedback = await correct_text_with_llm(test_student_text_example)
+        print("\n--- Feedback de Corrección Obtenido ---")
+        print(feedback)
+        print(f"\n(Versión del prompt de corrección usado: {CORRECTION_PROMPT_VERSION_CURRENT})")
+    except ValueError as ve:
+        print(f"Error de configuración (Lenguaje): {ve}")
+    except Exception as e:
+        print(f"Ocurrió un error durante la prueba de lenguaje: {e}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main_test())
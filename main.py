@@ -1,38 +1,148 @@
 # my-english-corrector-backend/main.py
-import os
 import uuid
-from datetime import datetime, timezone
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status as http_status, Body
+import hashlib
+import asyncio
+import contextlib
+import queue
+import atexit
+import logging
+import logging.handlers
+import anyio
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Depends, HTTPException, Request, UploadFile, File, Form, status as http_status, Body
 from fastapi.middleware.cors import CORSMiddleware
-from sqlmodel import Session, SQLModel, create_engine, select, func
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy import Integer, bindparam, delete, insert, or_, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import SQLModel, select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 from dotenv import load_dotenv
-from urllib.parse import urlparse
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+from cachetools import TTLCache
+import orjson
 
-from supabase import create_client, Client as SupabaseClient
+from supabase import ASupabaseStorageClient
 
+from config import get_settings
 from auth_utils import get_current_user, get_current_user_id, TokenPayload
 import models # models.py ahora tiene ExamPaper y ExamImage
 import llm_services
 
 load_dotenv()
+settings = get_settings()
+
+# Nivel INFO por defecto: los logger.debug con contenido de respuestas del LLM no llegan a formatearse.
+# Los handlers de la app solo encolan el registro; la escritura a stdout la hace el hilo del
+# QueueListener, de modo que el event loop nunca se bloquea escribiendo logs.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# El formato completo lo aplica el handler de stdout; aquí solo se resuelve el mensaje.
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=settings.log_level.upper(), handlers=[_log_queue_handler])
+_log_listener.start()
+# stop() vacía la cola, así que no se pierden los últimos mensajes al apagar.
+atexit.register(_log_listener.stop)
+
+# Los mensajes usan interpolación diferida ("%s", valor): si el nivel está desactivado no se formatean.
+logger = logging.getLogger(__name__)
 
 # --- Configuración de Base de Datos ---
-DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_URL = settings.database_url
 if not DATABASE_URL:
-    print("ERROR CRÍTICO: DATABASE_URL no está configurada.")
+    logger.critical("DATABASE_URL no está configurada.")
     exit()
-engine = create_engine(DATABASE_URL, echo=True, pool_pre_ping=True)
 
-# --- Configuración del Cliente de Supabase ---
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-    print("ERROR CRÍTICO: SUPABASE_URL o SUPABASE_SERVICE_ROLE_KEY no configuradas.")
-    supabase_admin_client: SupabaseClient | None = None
+
+def _async_database_url(database_url: str):
+    """
+    Adapta la DATABASE_URL (postgresql://... como la da Supabase) al driver asíncrono asyncpg.
+    asyncpg no entiende el parámetro sslmode de libpq, así que se pasa como ssl en connect_args.
+    Las URLs que ya indican un driver asíncrono (p. ej. sqlite+aiosqlite) se dejan tal cual.
+    """
+    url = make_url(database_url)
+    connect_args = {}
+    if url.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+        if "sslmode" in url.query:
+            connect_args["ssl"] = url.query["sslmode"]
+            url = url.difference_update_query(["sslmode"])
+    return url, connect_args
+
+
+_engine_url, _engine_connect_args = _async_database_url(DATABASE_URL)
+# El log de cada sentencia SQL (con sus parámetros) solo se activa en desarrollo: SQL_ECHO=1.
+# Se activa con el nivel del logger de SQLAlchemy y no con echo=True, que añadiría su propio handler
+# a stdout: así pasa por la misma cola que el resto de logs y no se duplica.
+SQL_ECHO = settings.sql_echo
+if SQL_ECHO:
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+# Detrás de PgBouncer (el pooler de Supabase escucha en 6543; PgBouncer por defecto en 6432) el
+# pool ya lo lleva el pooler: SQLAlchemy no mantiene el suyo (NullPool) y asyncpg no puede usar
+# sentencias preparadas con nombre fijo en modo transacción.
+DATABASE_USES_PGBOUNCER = settings.database_uses_pgbouncer or _engine_url.port in (6432, 6543)
+if DATABASE_USES_PGBOUNCER and _engine_url.drivername == "postgresql+asyncpg":
+    _engine_connect_args.update(
+        statement_cache_size=0,
+        prepared_statement_name_func=lambda: f"__asyncpg_{uuid.uuid4()}__",
+    )
+
+# Tamaño del pool ajustable por entorno (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE).
+DB_POOL_SIZE = settings.db_pool_size
+DB_MAX_OVERFLOW = settings.db_max_overflow
+DB_POOL_TIMEOUT = settings.db_pool_timeout
+DB_POOL_RECYCLE = settings.db_pool_recycle
+
+if DATABASE_USES_PGBOUNCER:
+    engine = create_async_engine(_engine_url, poolclass=NullPool, connect_args=_engine_connect_args)
 else:
-    supabase_admin_client: SupabaseClient = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    engine = create_async_engine(
+        _engine_url, connect_args=_engine_connect_args,
+        pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+        # pre_ping descarta conexiones que el servidor cerró mientras estaban ociosas y
+        # recycle las renueva antes de que lo haga un proxy o el propio Postgres.
+        pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE,
+    )
+
+# --- Configuración del Cliente de Supabase ---
+SUPABASE_URL = settings.supabase_url
+SUPABASE_SERVICE_ROLE_KEY = settings.supabase_service_role_key
+STORAGE_CONFIGURED = bool(SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY)
+if not STORAGE_CONFIGURED:
+    logger.critical("SUPABASE_URL o SUPABASE_SERVICE_ROLE_KEY no configuradas.")
+
+_storage_client: ASupabaseStorageClient | None = None
+
+def get_storage_client() -> ASupabaseStorageClient:
+    """
+    Retorna el cliente de Storage compartido por el proceso, creándolo la primera vez. Solo usamos
+    Storage: su cliente asíncrono comparte un httpx.AsyncClient (HTTP/2, keep-alive) entre todas las
+    peticiones, así que subidas y borrados no necesitan un hilo cada uno.
+    Quien lo llama comprueba antes STORAGE_CONFIGURED.
+    """
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = ASupabaseStorageClient(
+            f"{SUPABASE_URL}/storage/v1",
+            {"apiKey": SUPABASE_SERVICE_ROLE_KEY, "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}"},
+        )
+    return _storage_client
+
+async def close_storage_client() -> None:
+    """
+    Cierra el cliente de Storage al apagar la aplicación. Si se vuelve a usar (otro arranque de la
+    app en el mismo proceso, tests) get_storage_client crea uno nuevo.
+    """
+    global _storage_client
+    if _storage_client is not None:
+        await _storage_client.aclose()
+        _storage_client = None
 
 # --- Constantes de la Aplicación ---
 MAX_UPLOAD_SIZE_BYTES = 5 * 1024 * 1024
@@ -40,11 +150,165 @@ MAX_EXAM_PAPERS_PER_USER = 20
 TRANSCRIPTION_COST = 1
 CORRECTION_COST = 5
 EXAM_IMAGES_BUCKET = "exam-images"
+# Prefijo de las URLs públicas de las imágenes; lo que va detrás es la ruta dentro del bucket.
+STORAGE_URL_PREFIX = f"{SUPABASE_URL}/storage/v1/object/public/{EXAM_IMAGES_BUCKET}/"
+
+def _image_storage_path(storage_path: Optional[str], image_url: Optional[str]) -> Optional[str]:
+    """
+    Ruta de una imagen dentro del bucket. Las filas sin storage_path (las anteriores a
+    migrations/001 que su relleno no cubrió, o las que insertó la versión anterior mientras se
+    desplegaba esta) la recuperan de la URL pública. None si la URL no es de nuestro bucket.
+    """
+    if storage_path:
+        return storage_path
+    if image_url and image_url.startswith(STORAGE_URL_PREFIX):
+        return image_url[len(STORAGE_URL_PREFIX):]
+    return None
+# Subidas simultáneas a Supabase Storage (en todo el proceso) para no chocar con sus límites.
+STORAGE_UPLOAD_CONCURRENCY = 8
+# Llamadas simultáneas al modelo de visión (en todo el proceso) al transcribir páginas.
+TRANSCRIPTION_CONCURRENCY = 5
+RUN_MIGRATIONS_ON_STARTUP = settings.run_migrations_on_startup
+
+# Fábrica única de sesiones: todas las peticiones (y el guardado del streaming) abren su sesión
+# con la misma configuración en lugar de construir AsyncSession(engine) a mano.
+# expire_on_commit=False: tras un commit los objetos conservan los valores que acabamos de
+# escribir, así que devolverlos no obliga a recargarlos con otro SELECT.
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+async def create_db_and_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+async def _warm_up_db_pool() -> None:
+    """
+    Abre de golpe DB_POOL_SIZE conexiones y las devuelve al pool, para que las primeras
+    peticiones tras arrancar no paguen cada una el handshake TCP+TLS con Postgres.
+    Con PgBouncer no hay pool propio que calentar.
+    """
+    if DATABASE_USES_PGBOUNCER:
+        return
+    results = await asyncio.gather(
+        *(engine.connect().start() for _ in range(DB_POOL_SIZE)), return_exceptions=True
+    )
+    connections = [result for result in results if not isinstance(result, BaseException)]
+    # Las que sí se abrieron vuelven al pool aunque alguna otra haya fallado.
+    await asyncio.gather(*(connection.close() for connection in connections))
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.warning("No se pudo precalentar el pool de BD por completo (%s fallos): %s", len(errors), errors[0])
+    else:
+        logger.info("Pool de BD precalentado con %s conexiones.", len(connections))
+
+async def _check_db_connection() -> None:
+    """
+    Un SELECT 1 al arrancar: confirma que la BD responde (y con PgBouncer, que el pooler acepta
+    conexiones) sin tocar el esquema. Si falla solo se avisa; pool_pre_ping reintentará después.
+    """
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+        logger.info("Conexión con la BD verificada.")
+    except Exception as e:
+        logger.warning("La BD no respondió al arrancar: %s - %s", type(e).__name__, e)
+
+# Las correcciones en segundo plano y por streaming viven en la memoria del proceso: si se reinicia
+# (o cae) a mitad, su redacción se quedaría en 'correcting' y /correct ya no la aceptaría. Al
+# arrancar, las que llevan más de este tiempo en 'correcting' vuelven a 'transcribed' para que se
+# puedan corregir de nuevo (no se cobró nada: los créditos solo se descuentan al guardar el feedback).
+# El margen cubre las correcciones que aún esté terminando la instancia anterior en un despliegue.
+STALE_CORRECTION_AFTER_SECONDS = 15 * 60
+RESET_STALE_CORRECTIONS_STATEMENT = (
+    update(models.ExamPaper.__table__)
+    .where(models.ExamPaper.status == "correcting", models.ExamPaper.updated_at < bindparam("stale_before"))
+    .values(status="transcribed", updated_at=bindparam("now"))
+)
+
+async def _reset_stale_corrections() -> None:
+    current_time = datetime.now(timezone.utc)
+    try:
+        async with engine.begin() as connection:
+            result = await connection.execute(RESET_STALE_CORRECTIONS_STATEMENT, {
+                "stale_before": current_time - timedelta(seconds=STALE_CORRECTION_AFTER_SECONDS), "now": current_time,
+            })
+        if result.rowcount:
+            logger.warning("%s redacciones atascadas en 'correcting' devueltas a 'transcribed'.", result.rowcount)
+    except Exception as e:
+        logger.warning("No se pudieron revisar las correcciones interrumpidas: %s - %s", type(e).__name__, e)
+
+# Redacciones de subidas directas abandonadas (ver PENDING_UPLOAD_EXPIRES_AFTER_SECONDS). Son DELETE
+# de Core, sin el cascade del ORM: primero se borran sus imágenes y después las redacciones.
+SELECT_EXPIRED_PENDING_UPLOADS_STATEMENT = (
+    select(models.ExamPaper.__table__.c.id)
+    .where(models.ExamPaper.status == "pending_upload", models.ExamPaper.updated_at < bindparam("expired_before"))
+    .with_for_update(skip_locked=True)
+)
+DELETE_PENDING_UPLOAD_IMAGES_STATEMENT = (
+    delete(models.ExamImage.__table__)
+    .where(models.ExamImage.exam_paper_id.in_(bindparam("paper_ids", expanding=True)))
+    .returning(models.ExamImage.__table__.c.storage_path)
+)
+DELETE_PENDING_UPLOAD_PAPERS_STATEMENT = (
+    delete(models.ExamPaper.__table__)
+    .where(models.ExamPaper.id.in_(bindparam("paper_ids", expanding=True)))
+)
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+async def _delete_expired_pending_uploads() -> None:
+    try:
+        async with engine.begin() as connection:
+            paper_ids = (await connection.execute(
+                SELECT_EXPIRED_PENDING_UPLOADS_STATEMENT, {"expired_before": _pending_upload_expired_before()}
+            )).scalars().all()
+            if not paper_ids:
+                return
+            paths_on_storage = [path for path in (await connection.execute(
+                DELETE_PENDING_UPLOAD_IMAGES_STATEMENT, {"paper_ids": paper_ids}
+            )).scalars() if path]
+            await connection.execute(DELETE_PENDING_UPLOAD_PAPERS_STATEMENT, {"paper_ids": paper_ids})
+        logger.warning("%s subidas directas sin completar borradas por caducadas.", len(paper_ids))
+    except Exception as e:
+        logger.warning("No se pudieron borrar las subidas directas caducadas: %s - %s", type(e).__name__, e)
+        return
+    # Después del commit: si falla, solo quedan archivos huérfanos en el bucket.
+    await _remove_from_storage(paths_on_storage, "de subidas caducadas")
 
-app = FastAPI(title="English Corrector API", version="0.1.0")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El esquema se gestiona fuera de los workers: migrate.py aplica migrations/*.sql en el paso de
+    # release (ver Procfile y README). create_all solo se lanza si se pide explícitamente, p. ej.
+    # para levantar una BD local desde cero.
+    if RUN_MIGRATIONS_ON_STARTUP:
+        logger.info("Creando tablas en BD si no existen...")
+        await create_db_and_tables()
+    await _warm_up_db_pool()
+    await _check_db_connection()
+    await _reset_stale_corrections()
+    await _delete_expired_pending_uploads()
+    await llm_services.prewarm_llm_connections()
+    # tiktoken carga (y puede descargar) su tokenizador: fuera del event loop.
+    await asyncio.to_thread(llm_services.log_correction_prompt_token_count)
+    logger.info("Evento de startup completado.")
+    yield
+    # Deja terminar (con límite) las correcciones en segundo plano antes de cerrar pool y clientes.
+    # Las que no acaban a tiempo se cancelan y se espera a que salgan, para que ninguna siga usando
+    # los clientes ya cerrados; su redacción queda en 'correcting' y la recupera el siguiente
+    # arranque (_reset_stale_corrections).
+    if _background_corrections:
+        logger.info("Esperando %s correcciones en segundo plano...", len(_background_corrections))
+        _, pending_corrections = await asyncio.wait(_background_corrections, timeout=BACKGROUND_CORRECTION_SHUTDOWN_TIMEOUT_SECONDS)
+        if pending_corrections:
+            logger.warning("Se cancelan %s correcciones en segundo plano sin terminar.", len(pending_corrections))
+            for correction_task in pending_corrections:
+                correction_task.cancel()
+            await asyncio.gather(*pending_corrections, return_exceptions=True)
+    # Cierra las conexiones keep-alive abiertas con los proveedores LLM y Storage, y las del pool de BD.
+    await llm_services.close_shared_http_client()
+    await close_storage_client()
+    await engine.dispose()
+
+# orjson serializa las respuestas (listas de redacciones con su texto y feedback) bastante más
+# rápido que el json estándar.
+app = FastAPI(title="English Corrector API", version="0.1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -52,16 +316,18 @@ origins = [
     "https://corrector-frontend-git-main-juanfranbrvs-projects.vercel.app",
     "https://english-corrector-api.onrender.com"
 ]
-app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-
-@app.on_event("startup")
-def on_startup():
-    print("Creando tablas en BD si no existen...")
-    create_db_and_tables()
-    print("Evento de startup completado.")
+# Métodos y cabeceras explícitos (los que usa el frontend); el navegador cachea el preflight un día.
+# Se expone ETag para que el frontend pueda revalidar GET /exam_papers/{id} con If-None-Match.
+CORS_ALLOWED_METHODS = ["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"]
+CORS_ALLOWED_HEADERS = ["Authorization", "Content-Type", "If-None-Match"]
+app.add_middleware(
+    CORSMiddleware, allow_origins=origins, allow_credentials=True,
+    allow_methods=CORS_ALLOWED_METHODS, allow_headers=CORS_ALLOWED_HEADERS,
+    expose_headers=["ETag"], max_age=86400
+)
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with SessionLocal() as session:
         yield session
 
 class UserStatusResponse(TokenPayload):
@@ -78,140 +344,316 @@ class FilenameUpdate(BaseModel):
 class ImagesOrderUpdate(BaseModel):
     image_ids: List[int]
 
+class PlannedImageUpload(BaseModel):
+    filename: Optional[str] = None
+    content_type: str
+
+class PrepareUploadRequest(BaseModel):
+    images: List[PlannedImageUpload]
+    essay_title: Optional[str] = None
+
+class SignedImageUpload(BaseModel):
+    page_number: int
+    path: str
+    signed_url: str
+    token: str
+
+class PrepareUploadResponse(BaseModel):
+    paper_id: int
+    uploads: List[SignedImageUpload]
+
+class CommitUploadRequest(BaseModel):
+    paths: List[str]  # Las rutas que devolvió prepare_upload, en orden de página
+
+# El cuerpo de "/" (lo consultan los health checks de Render) es fijo: se codifica una sola vez.
+ROOT_RESPONSE_BODY = orjson.dumps({"message": "API del Corrector de Inglés lista!"})
+
 @app.get("/")
 async def read_root():
-    return {"message": "API del Corrector de Inglés lista!"}
+    return Response(content=ROOT_RESPONSE_BODY, media_type="application/json")
+
+# Caché de lo que devuelve /users/me/ (número de redacciones, créditos) por usuario. El frontend
+# lo consulta a menudo; los endpoints que crean o borran redacciones o descuentan créditos
+# invalidan la entrada, y el TTL acota el desfase ante cambios hechos fuera de la API (p. ej.
+# créditos añadidos a mano en la BD). Solo se usa para mostrar: las comprobaciones de cuota y
+# créditos siguen consultando la BD. Todo ocurre en el event loop, sin hilos: no necesita lock.
+USER_STATUS_CACHE_TTL_SECONDS = 30
+_user_status_cache: TTLCache = TTLCache(maxsize=10000, ttl=USER_STATUS_CACHE_TTL_SECONDS)
+
+def _invalidate_user_status(user_id: str) -> None:
+    _user_status_cache.pop(user_id, None)
+
+# Una subida directa que el cliente abandona deja su redacción en "pending_upload". Pasado este
+# tiempo (las URLs firmadas de Supabase caducan mucho antes) ya no cuenta para la cuota ni se puede
+# cerrar con commit_upload, y el siguiente arranque la borra (_delete_expired_pending_uploads).
+PENDING_UPLOAD_EXPIRES_AFTER_SECONDS = 24 * 60 * 60
+
+def _pending_upload_expired_before() -> datetime:
+    return datetime.now(timezone.utc) - timedelta(seconds=PENDING_UPLOAD_EXPIRES_AFTER_SECONDS)
+
+USER_PAPER_COUNT_SUBQUERY = select(func.count(models.ExamPaper.id)).where(
+    models.ExamPaper.user_id == bindparam("user_id"),
+    or_(models.ExamPaper.status != "pending_upload", models.ExamPaper.updated_at >= bindparam("pending_upload_expired_before")),
+)
+USER_CREDITS_SUBQUERY = select(models.User.credits).where(models.User.id == bindparam("user_id"))
+# Número de redacciones y créditos en una sola consulta (dos subconsultas escalares).
+# Los créditos vienen a NULL si el usuario aún no existe en la tabla local.
+USER_STATUS_STATEMENT = select(USER_PAPER_COUNT_SUBQUERY.scalar_subquery(), USER_CREDITS_SUBQUERY.scalar_subquery())
 
 @app.get("/users/me/", response_model=UserStatusResponse)
 async def read_users_me_with_status(
-    current_user_payload: TokenPayload = Depends(get_current_user), session: Session = Depends(get_session)
+    current_user_payload: TokenPayload = Depends(get_current_user), session: AsyncSession = Depends(get_session)
 ):
     user_id = current_user_payload.sub
-    count_statement = select(func.count(models.ExamPaper.id)).where(models.ExamPaper.user_id == user_id)
-    current_paper_count = session.exec(count_statement).one()
-    db_user_local = session.get(models.User, user_id)
-    user_credits = db_user_local.credits if db_user_local else 0
-    if not db_user_local:
-         print(f"ADVERTENCIA: Usuario {user_id} no encontrado en tabla local 'user' para /users/me.")
+    cached_status = _user_status_cache.get(user_id)
+    if cached_status is not None:
+        current_paper_count, user_credits = cached_status
+    else:
+        current_paper_count, user_credits = (await session.exec(USER_STATUS_STATEMENT, params={
+            "user_id": user_id, "pending_upload_expired_before": _pending_upload_expired_before(),
+        })).one()
+        if user_credits is None:
+             logger.warning("Usuario %s no encontrado en tabla local 'user' para /users/me.", user_id)
+             user_credits = 0
+        else:
+            _user_status_cache[user_id] = (current_paper_count, user_credits)
     return UserStatusResponse(**current_user_payload.model_dump(), current_paper_count=current_paper_count, max_paper_quota=MAX_EXAM_PAPERS_PER_USER, credits=user_credits)
 
 # --- Endpoints para ExamPapers ---
 
+MAX_FILENAME_LENGTH = 255 # Asume un límite razonable
+
+def _new_paper_filename(essay_title: Optional[str], first_image_filename: Optional[str]) -> str:
+    """
+    Nombre de una redacción nueva: el título del usuario, si no el nombre de la primera imagen
+    y, si tampoco hay, uno generado con la fecha. Se trunca a MAX_FILENAME_LENGTH.
+    """
+    paper_filename: str
+    if essay_title and essay_title.strip(): # Si el usuario proporcionó un título
+        paper_filename = essay_title.strip()
+    elif first_image_filename: # Usar el nombre del primer archivo como fallback
+        paper_filename = first_image_filename
+    else: # Generar un nombre por defecto si todo lo demás falla
+        current_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        paper_filename = f"Ensayo subido el {current_date} - {uuid.uuid4().hex[:6]}"
+    return paper_filename[:MAX_FILENAME_LENGTH]
+
+LOCK_USER_STATEMENT = select(models.User.id).where(models.User.id == bindparam("user_id")).with_for_update()
+
+# INSERT ... SELECT que solo devuelve fila si el usuario está por debajo de la cuota. Los parámetros
+# llevan el tipo de su columna para que el driver sepa convertirlos (la SELECT no tiene tabla de la
+# que deducirlo).
+_exam_paper_columns = models.ExamPaper.__table__.c
+INSERT_EXAM_PAPER_WITHIN_QUOTA_STATEMENT = (
+    insert(models.ExamPaper)
+    .from_select(
+        ["filename", "status", "user_id", "created_at", "updated_at"],
+        select(
+            bindparam("filename", type_=_exam_paper_columns.filename.type),
+            bindparam("status", type_=_exam_paper_columns.status.type),
+            bindparam("user_id", type_=_exam_paper_columns.user_id.type),
+            bindparam("created_at", type_=_exam_paper_columns.created_at.type),
+            bindparam("updated_at", type_=_exam_paper_columns.updated_at.type),
+        ).where(USER_PAPER_COUNT_SUBQUERY.scalar_subquery() < bindparam("max_papers", type_=Integer)),
+    )
+    .returning(models.ExamPaper)
+    # Con parámetros, un INSERT del ORM se trataría como inserción masiva de filas: "orm" lo ejecuta
+    # como una única sentencia y sigue devolviendo objetos ExamPaper.
+    .execution_options(dml_strategy="orm")
+)
+
+async def _create_exam_paper_within_quota(
+    session: AsyncSession, current_auth_user: TokenPayload, paper_filename: str, paper_status: str
+) -> models.ExamPaper:
+    """
+    Crea la redacción (sin commit) si el usuario no ha llegado a MAX_EXAM_PAPERS_PER_USER; si ya
+    está en el límite lanza 403.
+    La fila del usuario se bloquea (SELECT ... FOR UPDATE) hasta el commit, así dos subidas
+    simultáneas del mismo usuario no pueden pasar las dos la comprobación. El INSERT ... SELECT
+    solo inserta si el recuento está por debajo del límite: comprobación e inserción son una
+    única sentencia, que devuelve la fila nueva.
+    """
+    user_id = current_auth_user.sub
+    if (await session.exec(LOCK_USER_STATEMENT, params={"user_id": user_id})).one_or_none() is None:
+        # Esta lógica debería ser manejada por el trigger de base de datos ahora.
+        # Si el trigger está funcionando, el usuario debería existir aquí para un usuario autenticado.
+        logger.warning("Usuario %s no encontrado en tabla local 'user' durante la subida. El trigger debería haberlo creado.", user_id)
+        # Por robustez, lo creamos aquí como fallback (se guarda con el commit del paper). ON CONFLICT
+        # DO NOTHING: si el trigger u otra petición lo crea a la vez, no falla por clave duplicada.
+        new_db_user_data = models.UserCreate(id=user_id, email=current_auth_user.email, credits=0) # O los créditos iniciales por defecto
+        await session.exec(
+            pg_insert(models.User).values(**new_db_user_data.model_dump()).on_conflict_do_nothing(index_elements=["id"])
+        )
+        await session.exec(LOCK_USER_STATEMENT, params={"user_id": user_id})
+
+    current_time = datetime.now(timezone.utc)
+    insert_params = {
+        "filename": paper_filename, "status": paper_status, "user_id": user_id,
+        "created_at": current_time, "updated_at": current_time, "max_papers": MAX_EXAM_PAPERS_PER_USER,
+        "pending_upload_expired_before": current_time - timedelta(seconds=PENDING_UPLOAD_EXPIRES_AFTER_SECONDS),
+    }
+    db_exam_paper = (await session.exec(INSERT_EXAM_PAPER_WITHIN_QUOTA_STATEMENT, params=insert_params)).scalars().one_or_none()
+    if db_exam_paper is None:
+        await session.rollback()
+        raise HTTPException(status_code=http_status.HTTP_403_FORBIDDEN, detail=f"Límite de {MAX_EXAM_PAPERS_PER_USER} ensayos alcanzado.")
+    return db_exam_paper
+
+# Redacciones con un proceso del LLM en curso en este proceso (paper_id -> estado a mostrar,
+# p. ej. "transcribing"). Ese estado transitorio no se guarda en la BD: los GET lo superponen al
+# estado guardado. Con un único worker de uvicorn basta con un dict en memoria; con varios workers
+# o instancias no evitaría dos transcripciones del mismo paper en procesos distintos, y habría que
+# volver a reservarlo en la BD con un UPDATE ... WHERE status IN (...) condicional.
+_papers_in_progress: dict[int, str] = {}
+
+def _paper_read_with_progress(db_exam_paper: models.ExamPaper) -> models.ExamPaperRead:
+    paper_read = models.ExamPaperRead.model_validate(db_exam_paper)
+    in_progress_status = _papers_in_progress.get(paper_read.id)
+    if in_progress_status:
+        paper_read.status = in_progress_status
+    return paper_read
+
+UPLOAD_READ_CHUNK_SIZE = 64 * 1024
+
+async def _read_upload_limited(file_item: UploadFile) -> bytes:
+    """
+    Lee el archivo subido por bloques y corta con 413 en cuanto supera MAX_UPLOAD_SIZE_BYTES, sin
+    cargar en memoria el resto. Si Starlette ya conoce el tamaño, se rechaza sin leer nada.
+    """
+    too_large = HTTPException(status_code=http_status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Archivo '{file_item.filename}' demasiado grande (Máx {MAX_UPLOAD_SIZE_BYTES/(1024*1024)}MB).")
+    if file_item.size is not None and file_item.size > MAX_UPLOAD_SIZE_BYTES:
+        raise too_large
+    chunks: List[bytes] = []
+    total_size = 0
+    while chunk := await file_item.read(UPLOAD_READ_CHUNK_SIZE):
+        total_size += len(chunk)
+        if total_size > MAX_UPLOAD_SIZE_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# Firmas (primeros bytes) de los formatos que aceptan los modelos de visión -> (extensión, content type).
+# El tipo se deduce del contenido: el content type y la extensión que manda el cliente no se usan.
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": ("jpg", "image/jpeg"),
+    b"\x89PNG\r\n\x1a\n": ("png", "image/png"),
+    b"GIF87a": ("gif", "image/gif"),
+    b"GIF89a": ("gif", "image/gif"),
+}
+
+def _detect_image_type(contents: bytes) -> Optional[tuple[str, str]]:
+    """
+    Retorna (extensión, content_type) según la firma del archivo, o None si no es un formato admitido.
+    """
+    # WEBP es un contenedor RIFF: la marca "WEBP" va en los bytes 8-12, tras el tamaño.
+    if contents[:4] == b"RIFF" and contents[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return next((image_type for signature, image_type in IMAGE_SIGNATURES.items() if contents.startswith(signature)), None)
+
+# Extensión por content type admitido (es lo único que se acepta del cliente en la subida directa).
+IMAGE_EXTENSIONS_BY_CONTENT_TYPE = {content_type: extension for extension, content_type in IMAGE_SIGNATURES.values()}
+IMAGE_EXTENSIONS_BY_CONTENT_TYPE["image/webp"] = "webp"
+# Bytes que bastan para reconocer cualquiera de las firmas (WEBP necesita 12).
+IMAGE_SIGNATURE_LENGTH = 16
+
+_storage_upload_semaphore = asyncio.Semaphore(STORAGE_UPLOAD_CONCURRENCY)
+_transcription_semaphore = asyncio.Semaphore(TRANSCRIPTION_CONCURRENCY)
+
+async def _upload_images_to_storage(uploads: List[tuple[str, bytes, str]]) -> None:
+    """
+    Sube a Supabase Storage las imágenes (path, contenido, content_type) en paralelo.
+    Si alguna falla, elimina del bucket las que sí se subieron y relanza el primer error.
+    """
+    bucket = get_storage_client().from_(EXAM_IMAGES_BUCKET)
+
+    async def upload_one(path_on_storage: str, contents: bytes, content_type: str) -> None:
+        async with _storage_upload_semaphore:
+            logger.debug("Subiendo imagen a Supabase Storage: %s", path_on_storage)
+            await bucket.upload(
+                path=path_on_storage, file=contents, file_options={"content-type": content_type, "cache-control": "3600"}
+            )
+
+    results = await asyncio.gather(*(upload_one(*upload) for upload in uploads), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if not errors:
+        return
+    uploaded_paths = [upload[0] for upload, result in zip(uploads, results) if not isinstance(result, BaseException)]
+    if uploaded_paths:
+        try:
+            await bucket.remove(uploaded_paths)
+            logger.info("Eliminadas de Storage %s imágenes ya subidas tras un error de subida.", len(uploaded_paths))
+        except Exception as cleanup_error:
+            logger.warning("No se pudieron eliminar de Storage las imágenes %s: %s", uploaded_paths, cleanup_error)
+    raise errors[0]
+
 @app.post("/exam_papers/upload_multiple_images/", response_model=models.ExamPaperRead)
 async def upload_multiple_exam_images(
     files: List[UploadFile] = File(..., description="Lista de archivos de imagen del ensayo (páginas)"),
     essay_title: Optional[str] = Form(None, description="Título opcional para el ensayo proporcionado por el usuario"), # <--- NUEVO PARÁMETRO
     current_auth_user: TokenPayload = Depends(get_current_user),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
     user_id = current_auth_user.sub
-    user_email = current_auth_user.email
-
-    count_statement = select(func.count(models.ExamPaper.id)).where(models.ExamPaper.user_id == user_id)
-    current_paper_count = session.exec(count_statement).one()
-    if current_paper_count >= MAX_EXAM_PAPERS_PER_USER:
-        raise HTTPException(status_code=http_status.HTTP_403_FORBIDDEN, detail=f"Límite de {MAX_EXAM_PAPERS_PER_USER} ensayos alcanzado.")
 
-    if not supabase_admin_client:
+    if not STORAGE_CONFIGURED:
         raise HTTPException(status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE, detail="Servicio de almacenamiento no configurado.")
     if not files or len(files) == 0:
         raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="No se proporcionaron archivos de imagen.")
 
-    # Crear/Obtener usuario local
-    db_user = session.get(models.User, user_id)
-    if not db_user:
-        # Esta lógica debería ser manejada por el trigger de base de datos ahora.
-        # Si el trigger está funcionando, db_user no debería ser None aquí para un usuario autenticado.
-        # Podríamos lanzar un error si no se encuentra, asumiendo que el trigger DEBE haberlo creado.
-        print(f"ADVERTENCIA/ERROR: Usuario {user_id} no encontrado en tabla local 'user' durante la subida. El trigger debería haberlo creado.")
-        # Por robustez, podríamos crearlo aquí como fallback, pero idealmente el trigger lo maneja.
-        new_db_user_data = models.UserCreate(id=user_id, email=user_email, credits=0) # O los créditos iniciales por defecto
-        db_user = models.User.model_validate(new_db_user_data)
-        session.add(db_user)
-        # No hacer commit aún, se hará al final o con el paper
-
-    # 1. Crear el ExamPaper
-    # Determinar el nombre del archivo para el ExamPaper
-    paper_filename: str
-    if essay_title and essay_title.strip(): # Si el usuario proporcionó un título
-        paper_filename = essay_title.strip()
-    elif files[0].filename: # Usar el nombre del primer archivo como fallback
-        paper_filename = files[0].filename
-    else: # Generar un nombre por defecto si todo lo demás falla
-        current_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        paper_filename = f"Ensayo subido el {current_date} - {uuid.uuid4().hex[:6]}"
-    
-    # Truncar si es demasiado largo (opcional, depende de la longitud máxima de tu campo 'filename')
-    MAX_FILENAME_LENGTH = 255 # Asume un límite razonable
-    if len(paper_filename) > MAX_FILENAME_LENGTH:
-        paper_filename = paper_filename[:MAX_FILENAME_LENGTH]
-
-    db_exam_paper_data = models.ExamPaperCreate(filename=paper_filename, status="uploaded", user_id=user_id)
-    db_exam_paper = models.ExamPaper.model_validate(db_exam_paper_data)
-    session.add(db_exam_paper)
-    session.commit() 
-    session.refresh(db_exam_paper)
+    # 1. Crear el ExamPaper (comprobando la cuota en la misma sentencia)
+    paper_filename = _new_paper_filename(essay_title, files[0].filename)
+    db_exam_paper = await _create_exam_paper_within_quota(session, current_auth_user, paper_filename, "uploaded")
+    # El id se guarda aquí: tras un rollback los atributos quedan expirados y la sesión
+    # asíncrona no puede recargarlos de forma implícita.
+    paper_id = db_exam_paper.id
+    await session.commit()
+    _invalidate_user_status(user_id)
 
     uploaded_image_models: List[models.ExamImage] = []
     try:
+        # Primero se validan y leen todos los archivos; después se suben todos a la vez.
+        uploads: List[tuple[str, bytes, str]] = []
         for index, file_item in enumerate(files):
-            if not file_item.content_type or not file_item.content_type.startswith("image/"):
+            contents = await _read_upload_limited(file_item)
+            image_type = _detect_image_type(contents)
+            if image_type is None:
                 raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail=f"Archivo '{file_item.filename}' no es una imagen válida.")
-            
-            contents = await file_item.read()
-            if len(contents) > MAX_UPLOAD_SIZE_BYTES:
-                raise HTTPException(status_code=http_status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Archivo '{file_item.filename}' demasiado grande (Máx {MAX_UPLOAD_SIZE_BYTES/(1024*1024)}MB).")
-
-            original_image_filename = file_item.filename if file_item.filename else f"page_{index + 1}"
-            file_extension = original_image_filename.split(".")[-1].lower() if "." in original_image_filename else "png"
-            
+            file_extension, image_content_type = image_type
+
             unique_storage_filename = f"page_{index + 1}_{uuid.uuid4().hex[:12]}.{file_extension}"
-            path_on_storage = f"{user_id}/{db_exam_paper.id}/{unique_storage_filename}"
-            
-            print(f"Subiendo imagen a Supabase Storage: {path_on_storage}")
-            supabase_admin_client.storage.from_(EXAM_IMAGES_BUCKET).upload(
-                path=path_on_storage, file=contents, file_options={"content-type": file_item.content_type, "cache-control": "3600"}
-            )
-            image_public_url = f"{SUPABASE_URL}/storage/v1/object/public/{EXAM_IMAGES_BUCKET}/{path_on_storage}"
+            path_on_storage = f"{user_id}/{paper_id}/{unique_storage_filename}"
+            uploads.append((path_on_storage, contents, image_content_type))
+
+        await _upload_images_to_storage(uploads)
+
+        for index, (path_on_storage, _, _) in enumerate(uploads):
+            image_public_url = f"{STORAGE_URL_PREFIX}{path_on_storage}"
 
             db_exam_image_data = models.ExamImageCreate(
                 image_url=image_public_url,
                 page_number=index + 1, 
-                exam_paper_id=db_exam_paper.id
+                exam_paper_id=paper_id
             )
-            db_exam_image = models.ExamImage.model_validate(db_exam_image_data)
-            session.add(db_exam_image)
-            uploaded_image_models.append(db_exam_image)
-        
-        session.commit() 
-        for img_model in uploaded_image_models: 
-            session.refresh(img_model)
-        
-        session.refresh(db_exam_paper) 
-        if db_user:
-            session.refresh(db_user)
+            uploaded_image_models.append(models.ExamImage.model_validate(db_exam_image_data, update={"storage_path": path_on_storage}))
+        session.add_all(uploaded_image_models)
+        await session.commit()
+
+        # Con expire_on_commit=False el paper conserva sus valores; solo falta cargar la relación
+        # images, en una única consulta (en vez de un refresh por imagen más el del paper).
+        await session.refresh(db_exam_paper, attribute_names=["images"])
 
         return db_exam_paper
 
     except Exception as e:
         if session.is_active:
-            session.rollback()
-        print(f"Error durante la subida de múltiples imágenes: {type(e).__name__} - {e}")
-        paper_to_delete_on_error = session.get(models.ExamPaper, db_exam_paper.id)
-        if paper_to_delete_on_error:
-            # También deberíamos intentar eliminar las imágenes de Supabase Storage aquí si algunas se subieron
-            paths_to_delete_on_storage_error = []
-            # (Esta lógica de encontrar paths puede ser compleja si no todos los ExamImage se crearon)
-            # Por simplicidad en este ejemplo, nos enfocaremos en la BD
-            
-            # Eliminar ExamImages asociadas si existen en la BD
-            images_in_db_on_error = session.exec(select(models.ExamImage).where(models.ExamImage.exam_paper_id == db_exam_paper.id)).all()
-            for img_db in images_in_db_on_error:
-                session.delete(img_db)
-
-            session.delete(paper_to_delete_on_error)
-            session.commit()
-            print(f"ExamPaper ID {db_exam_paper.id} y sus imágenes asociadas eliminados de la BD debido a error en subida de imágenes.")
+            await session.rollback()
+        logger.error("Error durante la subida de múltiples imágenes: %s - %s", type(e).__name__, e)
+        # db_exam_paper sigue en la sesión (ya guardado): se borra sin volver a consultarlo. Las
+        # imágenes ya subidas a Storage las elimina _upload_images_to_storage; las ExamImage que
+        # hubiera en la BD se borran con la redacción (cascade de ExamPaper.images).
+        await session.delete(db_exam_paper)
+        await session.commit()
+        _invalidate_user_status(user_id)
+        logger.info("ExamPaper ID %s y sus imágenes asociadas eliminados de la BD debido a error en subida de imágenes.", paper_id)
         raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error interno al procesar archivos: {str(e)}")
     finally:
         for file_item in files:
@@ -219,97 +661,285 @@ async def upload_multiple_exam_images(
                 await file_item.close() # type: ignore
 
 
+@app.post("/exam_papers/prepare_upload/", response_model=PrepareUploadResponse)
+async def prepare_exam_paper_upload(
+    upload_request: PrepareUploadRequest,
+    current_auth_user: TokenPayload = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
+    """
+    Subida directa a Supabase Storage: crea la redacción (estado "pending_upload") y devuelve una
+    URL firmada por página. El cliente sube cada imagen a su URL y después llama a
+    /exam_papers/{paper_id}/commit_upload. Los bytes no pasan por este servidor.
+    """
+    user_id = current_auth_user.sub
+    if not STORAGE_CONFIGURED:
+        raise HTTPException(status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE, detail="Servicio de almacenamiento no configurado.")
+    if not upload_request.images:
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="No se proporcionaron archivos de imagen.")
+    # La extensión sale del content type declarado (no del nombre del archivo); que los bytes
+    # subidos sean de verdad de ese tipo se comprueba en commit_upload.
+    file_extensions = []
+    for planned_image in upload_request.images:
+        file_extension = IMAGE_EXTENSIONS_BY_CONTENT_TYPE.get(planned_image.content_type.split(";")[0].strip().lower())
+        if file_extension is None:
+            raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail=f"Archivo '{planned_image.filename}' no es una imagen válida.")
+        file_extensions.append(file_extension)
+
+    paper_filename = _new_paper_filename(upload_request.essay_title, upload_request.images[0].filename)
+    db_exam_paper = await _create_exam_paper_within_quota(session, current_auth_user, paper_filename, "pending_upload")
+    paper_id = db_exam_paper.id
+    paths_on_storage = [
+        f"{user_id}/{paper_id}/page_{index + 1}_{uuid.uuid4().hex[:12]}.{file_extension}"
+        for index, file_extension in enumerate(file_extensions)
+    ]
+    # Las rutas emitidas se guardan ya como ExamImage de la redacción pendiente: commit_upload
+    # solo acepta exactamente estas rutas.
+    session.add_all([
+        models.ExamImage.model_validate(models.ExamImageCreate(
+            image_url=f"{STORAGE_URL_PREFIX}{path_on_storage}",
+            page_number=index + 1,
+            exam_paper_id=paper_id,
+        ), update={"storage_path": path_on_storage})
+        for index, path_on_storage in enumerate(paths_on_storage)
+    ])
+    await session.commit()
+    _invalidate_user_status(user_id)
+
+    bucket = get_storage_client().from_(EXAM_IMAGES_BUCKET)
+
+    async def sign_one(path_on_storage: str) -> dict:
+        async with _storage_upload_semaphore:
+            return await bucket.create_signed_upload_url(path_on_storage)
+
+    try:
+        signed_uploads = await asyncio.gather(*(sign_one(path) for path in paths_on_storage))
+    except Exception as e:
+        logger.error("Error creando URLs firmadas para paper %s: %s - %s", paper_id, type(e).__name__, e)
+        await session.delete(db_exam_paper)
+        await session.commit()
+        _invalidate_user_status(user_id)
+        raise HTTPException(status_code=http_status.HTTP_502_BAD_GATEWAY, detail="No se pudieron preparar las subidas de imágenes.")
+
+    return PrepareUploadResponse(paper_id=paper_id, uploads=[
+        SignedImageUpload(page_number=index + 1, path=path_on_storage, signed_url=signed["signed_url"], token=signed["token"])
+        for index, (path_on_storage, signed) in enumerate(zip(paths_on_storage, signed_uploads))
+    ])
+
+
+@app.post("/exam_papers/{paper_id}/commit_upload", response_model=models.ExamPaperRead)
+async def commit_exam_paper_upload(
+    paper_id: int,
+    commit_request: CommitUploadRequest,
+    current_user_id: str = Depends(get_current_user_id),
+    session: AsyncSession = Depends(get_session)
+):
+    """
+    Cierra una subida directa: comprueba que las rutas son exactamente las que emitió
+    prepare_upload, que cada imagen está en Storage y que sus primeros bytes son de una imagen
+    admitida, y fija el orden de las páginas.
+    """
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
+    if not db_exam_paper:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Redacción no encontrada.")
+    if db_exam_paper.user_id != current_user_id:
+        raise HTTPException(status_code=http_status.HTTP_403_FORBIDDEN, detail="No tienes permiso.")
+    if db_exam_paper.status != "pending_upload":
+        raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail=f"La subida ya está cerrada. Estado: {db_exam_paper.status}")
+    # Caducada ya no cuenta para la cuota: cerrarla ahora podría dejar al usuario por encima del límite.
+    prepared_at = db_exam_paper.updated_at
+    if prepared_at.tzinfo is None:
+        prepared_at = prepared_at.replace(tzinfo=timezone.utc)
+    if prepared_at < _pending_upload_expired_before():
+        raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail="La subida ha caducado; vuelve a preparar la redacción.")
+    if not STORAGE_CONFIGURED:
+        raise HTTPException(status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE, detail="Servicio de almacenamiento no configurado.")
+    if not commit_request.paths:
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="No se indicaron imágenes subidas.")
+
+    paper_folder = f"{current_user_id}/{paper_id}"
+    images_by_path = {_image_storage_path(image.storage_path, image.image_url): image for image in db_exam_paper.images}
+    invalid_paths = [path for path in commit_request.paths if not _is_paper_object_path(path, paper_folder) or path not in images_by_path]
+    if invalid_paths or len(commit_request.paths) != len(set(commit_request.paths)):
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="Ruta de imagen no válida para esta redacción.")
+    if len(commit_request.paths) != len(images_by_path):
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="Faltan imágenes de las preparadas para esta redacción.")
+
+    images_bucket = get_storage_client().from_(EXAM_IMAGES_BUCKET)
+    image_heads = await asyncio.gather(*(_read_stored_image_head(path) for path in commit_request.paths))
+    missing_paths = [path for path, head in zip(commit_request.paths, image_heads) if head is None]
+    if missing_paths:
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail=f"Imágenes no encontradas en el almacenamiento: {missing_paths}")
+    not_image_paths = []
+    for path_on_storage, image_head in zip(commit_request.paths, image_heads):
+        image_type = _detect_image_type(image_head)
+        # La extensión de la ruta es la del content type declarado en prepare_upload.
+        if image_type is None or image_type[0] != path_on_storage.rsplit(".", 1)[-1]:
+            not_image_paths.append(path_on_storage)
+    if not_image_paths:
+        # Lo subido no es una imagen del tipo declarado: se borra del bucket. La redacción sigue
+        # pendiente, así que el cliente puede volver a subir esas páginas y repetir commit_upload.
+        try:
+            await images_bucket.remove(not_image_paths)
+        except Exception as e_storage:
+            logger.warning("No se pudieron eliminar de Storage los archivos no válidos %s: %s", not_image_paths, e_storage)
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail=f"Archivos que no son imágenes válidas: {not_image_paths}")
+
+    for index, path_on_storage in enumerate(commit_request.paths):
+        images_by_path[path_on_storage].page_number = index + 1
+    db_exam_paper.status = "uploaded"
+    db_exam_paper.updated_at = datetime.now(timezone.utc)
+    session.add(db_exam_paper)
+    await session.commit()
+    return db_exam_paper
+
+def _reject_pending_upload(db_exam_paper: models.ExamPaper) -> None:
+    """
+    409 si la redacción sigue en "pending_upload": sus ExamImage son las rutas emitidas por
+    prepare_upload y commit_upload exige exactamente esas, así que no se pueden añadir, borrar ni
+    reordenar imágenes hasta que se cierre la subida.
+    """
+    if db_exam_paper.status == "pending_upload":
+        raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail="La subida de imágenes de esta redacción no se ha completado.")
+
+def _is_paper_object_path(path: str, paper_folder: str) -> bool:
+    """
+    True si la ruta es exactamente "<paper_folder>/<nombre>", con un solo segmento tras la carpeta
+    (sin "/", sin "." ni "..", sin nombre vacío).
+    """
+    folder, separator, name = path.rpartition("/")
+    return bool(separator) and folder == paper_folder and name not in ("", ".", "..")
+
+async def _read_stored_image_head(path_on_storage: str) -> Optional[bytes]:
+    """
+    Descarga solo los primeros IMAGE_SIGNATURE_LENGTH bytes del objeto (petición con Range), para
+    reconocer su formato sin bajar la imagen entera. Retorna None si el objeto no existe.
+    """
+    async with _storage_upload_semaphore:
+        response = await get_storage_client().session.get(
+            f"object/{EXAM_IMAGES_BUCKET}/{path_on_storage}",
+            headers={"Range": f"bytes=0-{IMAGE_SIGNATURE_LENGTH - 1}"},
+        )
+    if response.status_code in (http_status.HTTP_400_BAD_REQUEST, http_status.HTTP_404_NOT_FOUND):
+        return None
+    response.raise_for_status()
+    return response.content[:IMAGE_SIGNATURE_LENGTH]
+
+
+# La consulta del listado se construye una sola vez; en cada petición solo cambian los
+# parámetros, y su SQL compilado sale siempre de la caché de SQLAlchemy.
+LIST_EXAM_PAPERS_STATEMENT = (
+    select(models.ExamPaper)
+    .where(models.ExamPaper.user_id == bindparam("user_id"))
+    .order_by(models.ExamPaper.created_at)
+    .offset(bindparam("skip"))
+    .limit(bindparam("limit"))
+)
+
+EXAM_PAPER_LIST_ADAPTER = TypeAdapter(List[models.ExamPaperRead])
+
 @app.get("/exam_papers/", response_model=List[models.ExamPaperRead])
 async def list_exam_papers_for_current_user(
-    user_id: str = Depends(get_current_user_id), session: Session = Depends(get_session),
+    user_id: str = Depends(get_current_user_id), session: AsyncSession = Depends(get_session),
     skip: int = 0, limit: int = 100
 ):
-    statement = (
-        select(models.ExamPaper)
-        .where(models.ExamPaper.user_id == user_id)
-        .order_by(getattr(models.ExamPaper, 'created_at'))
-        .offset(skip)
-        .limit(limit)
-    )
-    papers = session.exec(statement).all()
-    return papers
+    papers = (await session.exec(
+        LIST_EXAM_PAPERS_STATEMENT, params={"user_id": user_id, "skip": skip, "limit": limit}
+    )).all()
+    # Se valida y serializa directamente con el TypeAdapter (pydantic-core) en vez de pasar por
+    # la validación del response_model de FastAPI; response_model queda para el esquema OpenAPI.
+    paper_reads = EXAM_PAPER_LIST_ADAPTER.validate_python(papers, from_attributes=True)
+    if _papers_in_progress:
+        for paper_read in paper_reads:
+            paper_read.status = _papers_in_progress.get(paper_read.id, paper_read.status)
+    body = EXAM_PAPER_LIST_ADAPTER.dump_json(paper_reads)
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/exam_papers/{paper_id}", response_model=models.ExamPaperRead)
 async def get_exam_paper(
     paper_id: int,
+    request: Request,
     current_user_id: str = Depends(get_current_user_id),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper:
         raise HTTPException(status_code=404, detail="Redacción no encontrada.")
     if db_exam_paper.user_id != current_user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso para ver esta redacción.")
-    return db_exam_paper
+
+    # El ETag es un hash del cuerpo serializado (incluye las imágenes, que no tocan updated_at).
+    # Si el cliente ya tiene esa versión respondemos 304 sin cuerpo.
+    body = orjson.dumps(_paper_read_with_progress(db_exam_paper).model_dump(mode="json"))
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=http_status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    return Response(content=body, media_type="application/json", headers=cache_headers)
 
 
+async def _remove_from_storage(paths_on_storage: List[str], description: str) -> None:
+    """
+    Borra los objetos del bucket en una sola petición. Un fallo solo se registra: se llama después
+    de borrar sus filas de la BD, y un archivo huérfano es inofensivo.
+    """
+    if not paths_on_storage or not STORAGE_CONFIGURED:
+        return
+    logger.debug("Intentando eliminar de Supabase Storage: %s", paths_on_storage)
+    try:
+        await get_storage_client().from_(EXAM_IMAGES_BUCKET).remove(paths_on_storage)
+    except Exception as e_storage:
+        logger.warning("No se pudieron eliminar de Storage las imágenes %s (%s): %s", description, paths_on_storage, e_storage)
+
 @app.delete("/exam_papers/{paper_id}", response_model=models.ExamPaperRead)
 async def delete_exam_paper(
     paper_id: int, current_user_id: str = Depends(get_current_user_id),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper:
         raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Redacción no encontrada.")
     if db_exam_paper.user_id != current_user_id:
         raise HTTPException(status_code=http_status.HTTP_403_FORBIDDEN, detail="No tienes permiso para eliminar.")
     
-    try:
-        images_to_delete = session.exec(select(models.ExamImage).where(models.ExamImage.exam_paper_id == paper_id)).all()
-        temp_paper_dict = db_exam_paper.model_dump()
-        temp_paper_dict["images"] = [img.model_dump() for img in images_to_delete]
-        deleted_paper_data_for_response = models.ExamPaperRead.model_validate(temp_paper_dict)
-    except Exception as e_val:
-        print(f"Error validando ExamPaperRead para delete response: {e_val}")
-        deleted_paper_data_for_response = models.ExamPaperRead.model_validate(db_exam_paper)
-
-    paths_on_storage_to_delete = []
-    if supabase_admin_client and EXAM_IMAGES_BUCKET and SUPABASE_URL:
-        for image_obj in images_to_delete: 
-            if image_obj.image_url:
-                try:
-                    parsed_url = urlparse(image_obj.image_url)
-                    prefix_to_remove = f"/storage/v1/object/public/{EXAM_IMAGES_BUCKET}/"
-                    if parsed_url.path.startswith(prefix_to_remove):
-                        paths_on_storage_to_delete.append(parsed_url.path[len(prefix_to_remove):])
-                except Exception as e_parse:
-                    print(f"Error parseando URL de imagen para eliminar: {e_parse}")
+    # ExamPaper.images es lazy="selectin": el session.get ya trajo las imágenes en la misma ida
+    # a la BD, así que no hace falta volver a consultarlas.
+    images_to_delete = list(db_exam_paper.images)
+    deleted_paper_data_for_response = models.ExamPaperRead.model_validate(db_exam_paper)
+
+    paths_on_storage_to_delete = [
+        path_on_storage for path_on_storage in (
+            _image_storage_path(image_obj.storage_path, image_obj.image_url) for image_obj in images_to_delete
+        ) if path_on_storage
+    ]
     
     try:
-        for image_obj in images_to_delete:
-            session.delete(image_obj)
-        session.delete(db_exam_paper)
-
-        if paths_on_storage_to_delete and supabase_admin_client:
-            print(f"Intentando eliminar de Supabase Storage: {paths_on_storage_to_delete}")
-            if paths_on_storage_to_delete:
-                 supabase_admin_client.storage.from_(EXAM_IMAGES_BUCKET).remove(paths_on_storage_to_delete)
-                 print("Solicitud de eliminación enviada a Supabase Storage.")
-        
-        session.commit()
-        print(f"Redacción ID: {paper_id} y sus imágenes eliminadas de la BD.")
-        return deleted_paper_data_for_response
+        # Las imágenes se borran con la redacción (cascade de ExamPaper.images).
+        await session.delete(db_exam_paper)
+        await session.commit()
     except Exception as e_db:
         if session.is_active:
-            session.rollback()
-        print(f"Error al eliminar la redacción ID: {paper_id} de la BD: {e_db}")
+            await session.rollback()
+        logger.error("Error al eliminar la redacción ID: %s de la BD: %s", paper_id, e_db)
         raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error al eliminar la redacción.")
+    _invalidate_user_status(current_user_id)
+    logger.info("Redacción ID: %s y sus imágenes eliminadas de la BD.", paper_id)
+
+    # Storage solo se toca tras el commit: si el borrado en BD falla, las imágenes siguen en su sitio
+    # y el cliente puede reintentar. Un archivo huérfano en el bucket no impide borrar la redacción.
+    await _remove_from_storage(paths_on_storage_to_delete, f"de la redacción {paper_id}")
+    return deleted_paper_data_for_response
 
 
 @app.post("/exam_papers/{paper_id}/transcribe", response_model=models.ExamPaperRead)
 async def transcribe_exam_paper_endpoint(
     paper_id: int,
     current_auth_user: TokenPayload = Depends(get_current_user),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
     user_id = current_auth_user.sub
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     
     if not db_exam_paper:
         raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail=f"Redacción ID {paper_id} no encontrada.")
@@ -322,68 +952,86 @@ async def transcribe_exam_paper_endpoint(
     allowed_initial_states = ["uploaded", "error_transcription"]
     if db_exam_paper.status not in allowed_initial_states:
         raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail=f"No se puede transcribir. Estado: {db_exam_paper.status}")
+    # El estado "transcribing" ya no se escribe en la BD (era un commit más por petición): se
+    # anota en _papers_in_progress, que además evita dos transcripciones a la vez del mismo paper.
+    # Comprobación y marca van seguidas, sin ningún await entre medias, para que dos peticiones
+    # simultáneas no puedan pasar las dos. Ojo: el registro es de este proceso; solo protege
+    # mientras la API corra en un único worker de uvicorn (como en el despliegue actual).
+    if paper_id in _papers_in_progress:
+        raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail=f"No se puede transcribir. Estado: {_papers_in_progress[paper_id]}")
+    _papers_in_progress[paper_id] = "transcribing"
+    try:
+        db_user = await session.get(models.User, user_id)
+        if not db_user: # Esto no debería suceder si el trigger está funcionando
+            raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Usuario no encontrado.")
+        if db_user.credits < TRANSCRIPTION_COST:
+            raise HTTPException(status_code=http_status.HTTP_402_PAYMENT_REQUIRED, detail=f"Créditos insuficientes ({db_user.credits}/{TRANSCRIPTION_COST}).")
 
-    db_user = session.get(models.User, user_id)
-    if not db_user: # Esto no debería suceder si el trigger está funcionando
-        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Usuario no encontrado.")
-    if db_user.credits < TRANSCRIPTION_COST:
-        raise HTTPException(status_code=http_status.HTTP_402_PAYMENT_REQUIRED, detail=f"Créditos insuficientes ({db_user.credits}/{TRANSCRIPTION_COST}).")
+        # Este commit no escribe nada; solo cierra la transacción de lectura para que la conexión
+        # vuelva al pool mientras duran las llamadas al LLM.
+        await session.commit()
+        return await _run_transcription(session, db_exam_paper, db_user)
+    finally:
+        _papers_in_progress.pop(paper_id, None)
 
-    db_exam_paper.status = "transcribing"
-    db_exam_paper.updated_at = datetime.now(timezone.utc)
-    session.add(db_exam_paper)
-    session.commit()
-    session.refresh(db_exam_paper)
 
-    full_transcribed_text_parts = []
-    any_page_transcription_failed = False
-    
+async def _run_transcription(session: AsyncSession, db_exam_paper: models.ExamPaper, db_user: models.User) -> models.ExamPaper:
+    """
+    Transcribe todas las páginas de la redacción y guarda en un único commit el texto, el estado
+    final y el descuento de créditos.
+    """
+    paper_id = db_exam_paper.id
+    user_id = db_user.id
     sorted_images = sorted(db_exam_paper.images, key=lambda img: img.page_number if img.page_number is not None else float('inf')) # type: ignore
 
-    for index, image_obj in enumerate(sorted_images):
-        page_prefix = f"--- Página {image_obj.page_number or index + 1} ---\n"
-        page_suffix = f"\n--- Fin de Página {image_obj.page_number or index + 1} ---\n\n"
-        
+    async def transcribe_page(page_number: int, image_url: str) -> tuple[str, bool]:
+        page_prefix = f"--- Página {page_number} ---\n"
+        page_suffix = f"\n--- Fin de Página {page_number} ---\n\n"
         try:
-            print(f"Transcribiendo página {image_obj.page_number or index + 1} (URL: {image_obj.image_url})")
-            page_transcription = await llm_services.transcribe_image_url_with_llm(image_url=image_obj.image_url)
-            
+            async with _transcription_semaphore:
+                logger.debug("Transcribiendo página %s (URL: %s)", page_number, image_url)
+                page_transcription = await llm_services.transcribe_image_url_with_llm(image_url=image_url)
             if page_transcription and page_transcription.strip():
-                full_transcribed_text_parts.append(page_prefix + page_transcription.strip() + page_suffix)
-            else:
-                full_transcribed_text_parts.append(page_prefix + "[Transcripción vacía para esta página]" + page_suffix)
+                return page_prefix + page_transcription.strip() + page_suffix, False
+            return page_prefix + "[Transcripción vacía para esta página]" + page_suffix, False
         except Exception as e_llm_page:
-            print(f"Error al transcribir página {image_obj.page_number or index + 1}: {e_llm_page}")
-            full_transcribed_text_parts.append(page_prefix + "[ERROR EN TRANSCRIPCIÓN DE ESTA PÁGINA]" + page_suffix)
-            any_page_transcription_failed = True
+            logger.error("Error al transcribir página %s: %s", page_number, e_llm_page)
+            return page_prefix + "[ERROR EN TRANSCRIPCIÓN DE ESTA PÁGINA]" + page_suffix, True
+
+    # Las páginas se transcriben a la vez (hasta TRANSCRIPTION_CONCURRENCY); gather respeta el
+    # orden, así que el texto final sale en el orden de las páginas.
+    page_results = await asyncio.gather(*(
+        transcribe_page(image_obj.page_number or index + 1, image_obj.image_url)
+        for index, image_obj in enumerate(sorted_images)
+    ))
+    full_transcribed_text_parts = [page_text for page_text, _ in page_results]
+    any_page_transcription_failed = any(page_failed for _, page_failed in page_results)
 
     final_transcribed_text = "".join(full_transcribed_text_parts).strip()
 
     try:
-        session.refresh(db_user) 
-        session.refresh(db_exam_paper)
+        await session.refresh(db_user) 
+        await session.refresh(db_exam_paper)
 
         if final_transcribed_text:
             db_exam_paper.transcribed_text = final_transcribed_text
             if any_page_transcription_failed:
                 db_exam_paper.status = "error_transcription" 
-                print(f"Transcripción para paper {paper_id} completada con errores en algunas páginas.")
+                logger.info("Transcripción para paper %s completada con errores en algunas páginas.", paper_id)
             else:
                 db_exam_paper.status = "transcribed"
                 db_exam_paper.transcription_credits_consumed = TRANSCRIPTION_COST
                 db_user.credits -= TRANSCRIPTION_COST
                 session.add(db_user)
-                print(f"Créditos descontados (transcripción) para {user_id}. Saldo: {db_user.credits}")
+                logger.info("Créditos descontados (transcripción) para %s. Saldo: %s", user_id, db_user.credits)
         else: 
             db_exam_paper.status = "error_transcription"
-            print(f"Transcripción falló completamente para paper {paper_id}. No se obtuvo texto.")
+            logger.info("Transcripción falló completamente para paper %s. No se obtuvo texto.", paper_id)
 
         db_exam_paper.updated_at = datetime.now(timezone.utc)
         session.add(db_exam_paper)
-        session.commit()
-        session.refresh(db_exam_paper)
-        if db_user:
-            session.refresh(db_user)
+        await session.commit()
+        _invalidate_user_status(user_id)
 
         if not final_transcribed_text and any_page_transcription_failed:
             raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error durante la transcripción IA. No se obtuvo texto.")
@@ -392,26 +1040,26 @@ async def transcribe_exam_paper_endpoint(
         
     except Exception as e_db_update:
         if session.is_active:
-            session.rollback()
-        print(f"Error DB post-transcripción paper {paper_id}: {e_db_update}")
+            await session.rollback()
+        logger.error("Error DB post-transcripción paper %s: %s", paper_id, e_db_update)
         try:
-            paper_to_recover = session.get(models.ExamPaper, paper_id)
+            paper_to_recover = await session.get(models.ExamPaper, paper_id)
             if paper_to_recover and paper_to_recover.status != "error_transcription":
                 paper_to_recover.status = "error_transcription"
                 paper_to_recover.updated_at = datetime.now(timezone.utc)
                 session.add(paper_to_recover)
-                session.commit()
+                await session.commit()
         except Exception as e_recovery:
-            print(f"Error adicional marcando paper {paper_id} como error: {e_recovery}")
+            logger.error("Error adicional marcando paper %s como error: %s", paper_id, e_recovery)
         raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error guardando resultado de transcripción.")
 
 
 @app.put("/exam_papers/{paper_id}/transcribed_text", response_model=models.ExamPaperRead)
 async def update_exam_paper_transcribed_text(
     paper_id: int, update_data: TranscribedTextUpdate,
-    current_user_id: str = Depends(get_current_user_id), session: Session = Depends(get_session)
+    current_user_id: str = Depends(get_current_user_id), session: AsyncSession = Depends(get_session)
 ):
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper:
         raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail=f"Redacción ID {paper_id} no encontrada.")
     if db_exam_paper.user_id != current_user_id:
@@ -422,21 +1070,39 @@ async def update_exam_paper_transcribed_text(
     
     if db_exam_paper.status in ["error_transcription", "uploaded"] and update_data.transcribed_text and update_data.transcribed_text.strip():
         db_exam_paper.status = "transcribed"
-        print(f"Estado de ExamPaper ID: {paper_id} cambiado a 'transcribed' tras edición manual.")
+        logger.info("Estado de ExamPaper ID: %s cambiado a 'transcribed' tras edición manual.", paper_id)
     
     session.add(db_exam_paper)
-    session.commit()
-    session.refresh(db_exam_paper)
+    await session.commit()
     return db_exam_paper
 
 
-@app.post("/exam_papers/{paper_id}/correct", response_model=models.ExamPaperRead)
+class CorrectionAccepted(BaseModel):
+    paper_id: int
+    status: str
+
+# Correcciones lanzadas con ?background=true. Se guarda una referencia fuerte a cada tarea
+# (asyncio solo guarda referencias débiles) hasta que termina.
+_background_corrections: set[asyncio.Task] = set()
+BACKGROUND_CORRECTION_SHUTDOWN_TIMEOUT_SECONDS = 60
+
+@app.post(
+    "/exam_papers/{paper_id}/correct", response_model=models.ExamPaperRead,
+    responses={http_status.HTTP_202_ACCEPTED: {"model": CorrectionAccepted}},
+)
 async def correct_exam_paper_endpoint(
     paper_id: int, current_auth_user: TokenPayload = Depends(get_current_user),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session),
+    background: bool = False,
 ):
+    """
+    Corrige la redacción con el LLM. Por defecto espera al resultado y devuelve la redacción
+    corregida. Con ?background=true responde 202 en cuanto la redacción pasa a 'correcting' y la
+    corrección sigue en segundo plano; el cliente consulta GET /exam_papers/{paper_id} hasta ver
+    'corrected' o 'error_correction'.
+    """
     user_id = current_auth_user.sub
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper:
         raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail=f"Redacción ID {paper_id} no encontrada.")
     if db_exam_paper.user_id != user_id:
@@ -446,7 +1112,7 @@ async def correct_exam_paper_endpoint(
     if not db_exam_paper.transcribed_text or not db_exam_paper.transcribed_text.strip():
         raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="Redacción sin texto transcrito para corregir.")
 
-    db_user = session.get(models.User, user_id)
+    db_user = await session.get(models.User, user_id)
     if not db_user: # No debería pasar con el trigger
         raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error de datos de usuario.")
     if db_user.credits < CORRECTION_COST:
@@ -455,8 +1121,18 @@ async def correct_exam_paper_endpoint(
     db_exam_paper.status = "correcting"
     db_exam_paper.updated_at = datetime.now(timezone.utc)
     session.add(db_exam_paper)
-    session.commit()
-    session.refresh(db_exam_paper)
+    await session.commit()
+
+    if background:
+        correction_task = asyncio.create_task(
+            _run_background_correction(paper_id, user_id, db_exam_paper.transcribed_text)
+        )
+        _background_corrections.add(correction_task)
+        correction_task.add_done_callback(_background_corrections.discard)
+        return Response(
+            content=orjson.dumps({"paper_id": paper_id, "status": db_exam_paper.status}),
+            status_code=http_status.HTTP_202_ACCEPTED, media_type="application/json",
+        )
 
     correction_feedback_result: str | None = None
     correction_successful = False
@@ -465,56 +1141,174 @@ async def correct_exam_paper_endpoint(
         if correction_feedback_result and correction_feedback_result.strip():
             correction_successful = True
     except Exception as e_llm:
-        print(f"Error LLM corrección paper {paper_id}: {e_llm}")
+        logger.error("Error LLM corrección paper %s: %s", paper_id, e_llm)
 
     try:
-        session.refresh(db_user)
-        session.refresh(db_exam_paper)
-        current_time = datetime.now(timezone.utc)
-        if correction_successful and correction_feedback_result:
-            db_exam_paper.corrected_feedback = correction_feedback_result
-            db_exam_paper.status = "corrected"
-            db_exam_paper.correction_credits_consumed = CORRECTION_COST
-            db_exam_paper.correction_prompt_version = llm_services.CORRECTION_PROMPT_VERSION_CURRENT
-            db_exam_paper.corrected_at = current_time
-            db_user.credits -= CORRECTION_COST
-            session.add(db_user)
-            print(f"Créditos descontados (corrección) para {user_id}. Saldo: {db_user.credits}")
-        else:
-            db_exam_paper.status = "error_correction"
-            print(f"Corrección falló o vacía para paper {paper_id}. No se descontaron créditos.")
-        db_exam_paper.updated_at = current_time
-        session.add(db_exam_paper)
-        session.commit()
-        session.refresh(db_exam_paper)
-        if db_user:
-            session.refresh(db_user)
+        await session.refresh(db_user)
+        await session.refresh(db_exam_paper)
+        await _store_correction_result(session, db_exam_paper, db_user, correction_feedback_result if correction_successful else None)
         if not correction_successful:
             raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error durante corrección IA.")
         return db_exam_paper
     except Exception as e_db_update:
-        if session.is_active:
-            session.rollback()
-        print(f"Error DB post-corrección paper {paper_id}: {e_db_update}")
-        try: 
-            paper_to_recover = session.get(models.ExamPaper, paper_id)
-            if paper_to_recover and paper_to_recover.status != "error_correction":
-                paper_to_recover.status = "error_correction"
-                paper_to_recover.updated_at = datetime.now(timezone.utc)
-                session.add(paper_to_recover)
-                session.commit()
-        except Exception as e_recovery:
-            print(f"Error adicional marcando paper {paper_id} como error_correction: {e_recovery}")
+        await _recover_failed_correction(session, paper_id, e_db_update)
         raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error guardando resultado de corrección.")
 
+
+async def _run_background_correction(paper_id: int, user_id: str, text_to_correct: str) -> None:
+    """
+    Corrección lanzada con ?background=true: llama al LLM y guarda el resultado con su propia
+    sesión (la de la petición ya se cerró).
+    """
+    correction_feedback: str | None = None
+    try:
+        correction_feedback = await llm_services.correct_text_with_llm(text_to_correct=text_to_correct)
+    except Exception as e_llm:
+        logger.error("Error LLM corrección (segundo plano) paper %s: %s", paper_id, e_llm)
+
+    async with SessionLocal() as background_session:
+        try:
+            db_exam_paper = await background_session.get(models.ExamPaper, paper_id)
+            db_user = await background_session.get(models.User, user_id)
+            if not db_exam_paper or not db_user:
+                logger.info("Paper %s o usuario %s ya no existen; se descarta la corrección en segundo plano.", paper_id, user_id)
+                return
+            await _store_correction_result(background_session, db_exam_paper, db_user, correction_feedback)
+        except Exception as e_db_update:
+            await _recover_failed_correction(background_session, paper_id, e_db_update)
+
+
+async def _store_correction_result(
+    session: AsyncSession, db_exam_paper: models.ExamPaper, db_user: models.User, correction_feedback: str | None
+) -> bool:
+    """
+    Guarda el resultado de una corrección: si hay feedback marca la redacción como
+    'corrected' y descuenta los créditos; si no, la marca como 'error_correction'.
+    Retorna True si la redacción quedó corregida.
+    """
+    current_time = datetime.now(timezone.utc)
+    if correction_feedback and correction_feedback.strip():
+        db_exam_paper.corrected_feedback = correction_feedback
+        db_exam_paper.status = "corrected"
+        db_exam_paper.correction_credits_consumed = CORRECTION_COST
+        db_exam_paper.correction_prompt_version = llm_services.CORRECTION_PROMPT_VERSION_CURRENT
+        db_exam_paper.corrected_at = current_time
+        db_user.credits -= CORRECTION_COST
+        session.add(db_user)
+        logger.info("Créditos descontados (corrección) para %s. Saldo: %s", db_user.id, db_user.credits)
+    else:
+        db_exam_paper.status = "error_correction"
+        logger.info("Corrección falló o vacía para paper %s. No se descontaron créditos.", db_exam_paper.id)
+    correction_stored = db_exam_paper.status == "corrected"
+    db_exam_paper.updated_at = current_time
+    session.add(db_exam_paper)
+    await session.commit()
+    _invalidate_user_status(db_user.id)
+    return correction_stored
+
+
+async def _recover_failed_correction(session: AsyncSession, paper_id: int, error: Exception) -> None:
+    """
+    Tras un error guardando la corrección, deja la redacción en 'error_correction'.
+    """
+    if session.is_active:
+        await session.rollback()
+    logger.error("Error DB post-corrección paper %s: %s", paper_id, error)
+    try: 
+        paper_to_recover = await session.get(models.ExamPaper, paper_id)
+        if paper_to_recover and paper_to_recover.status != "error_correction":
+            paper_to_recover.status = "error_correction"
+            paper_to_recover.updated_at = datetime.now(timezone.utc)
+            session.add(paper_to_recover)
+            await session.commit()
+    except Exception as e_recovery:
+        logger.error("Error adicional marcando paper %s como error_correction: %s", paper_id, e_recovery)
+
+
+def _sse_event(data: str, event: str | None = None) -> str:
+    """
+    Formatea un evento Server-Sent Events. Cada línea del texto va en su propia línea 'data:'.
+    """
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+@app.post("/exam_papers/{paper_id}/correct/stream")
+async def correct_exam_paper_stream_endpoint(
+    paper_id: int, current_auth_user: TokenPayload = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
+    """
+    Igual que /correct, pero envía el feedback al cliente (text/event-stream) a medida que el
+    LLM lo genera. Al terminar se guarda el resultado y se emite un evento 'done' o 'error'.
+    """
+    user_id = current_auth_user.sub
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
+    if not db_exam_paper:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail=f"Redacción ID {paper_id} no encontrada.")
+    if db_exam_paper.user_id != user_id:
+        raise HTTPException(status_code=http_status.HTTP_403_FORBIDDEN, detail="No tienes permiso.")
+    if db_exam_paper.status != "transcribed":
+        raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail=f"Solo se pueden corregir redacciones transcritas. Estado: {db_exam_paper.status}")
+    if not db_exam_paper.transcribed_text or not db_exam_paper.transcribed_text.strip():
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="Redacción sin texto transcrito para corregir.")
+
+    db_user = await session.get(models.User, user_id)
+    if not db_user:
+        raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error de datos de usuario.")
+    if db_user.credits < CORRECTION_COST:
+        raise HTTPException(status_code=http_status.HTTP_402_PAYMENT_REQUIRED, detail=f"Créditos insuficientes ({db_user.credits}/{CORRECTION_COST}).")
+
+    text_to_correct = db_exam_paper.transcribed_text
+    db_exam_paper.status = "correcting"
+    db_exam_paper.updated_at = datetime.now(timezone.utc)
+    session.add(db_exam_paper)
+    await session.commit()
+
+    async def event_stream():
+        feedback_parts: list[str] = []
+        stream_completed = False
+        correction_saved = False
+        try:
+            async for chunk in llm_services.stream_correct_text_with_llm(text_to_correct):
+                feedback_parts.append(chunk)
+                yield _sse_event(chunk)
+            stream_completed = True
+        except Exception as e_llm:
+            logger.error("Error LLM corrección (streaming) paper %s: %s", paper_id, e_llm)
+        finally:
+            # La sesión de la petición ya está cerrada cuando se emite el cuerpo de la respuesta,
+            # así que el resultado se guarda con una sesión propia. Si el cliente se desconecta a
+            # mitad, Starlette cancela esta tarea y cualquier await de aquí se cancelaría también:
+            # el guardado va en un CancelScope blindado para que la redacción no se quede en
+            # 'correcting' (pasa a 'error_correction', sin cobrar créditos).
+            with anyio.CancelScope(shield=True):
+                async with SessionLocal() as stream_session:
+                    try:
+                        paper = await stream_session.get(models.ExamPaper, paper_id)
+                        user = await stream_session.get(models.User, user_id)
+                        if paper and user:
+                            feedback = "".join(feedback_parts) if stream_completed else None
+                            correction_saved = await _store_correction_result(stream_session, paper, user, feedback)
+                    except Exception as e_db_update:
+                        await _recover_failed_correction(stream_session, paper_id, e_db_update)
+        yield _sse_event("corrected" if correction_saved else "Error durante corrección IA.",
+                         event="done" if correction_saved else "error")
+
+    return StreamingResponse(
+        event_stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.put("/exam_papers/{paper_id}/filename", response_model=models.ExamPaperRead)
 async def update_exam_paper_filename(
     paper_id: int,
     update_data: FilenameUpdate,
     current_user_id: str = Depends(get_current_user_id),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper:
         raise HTTPException(status_code=404, detail=f"Redacción ID {paper_id} no encontrada.")
     if db_exam_paper.user_id != current_user_id:
@@ -528,8 +1322,7 @@ async def update_exam_paper_filename(
     db_exam_paper.filename = new_filename
     db_exam_paper.updated_at = datetime.now(timezone.utc)
     session.add(db_exam_paper)
-    session.commit()
-    session.refresh(db_exam_paper)
+    await session.commit()
     return db_exam_paper
 
 @app.post("/exam_papers/{paper_id}/add_images", response_model=models.ExamPaperRead)
@@ -537,76 +1330,80 @@ async def add_images_to_exam_paper(
     paper_id: int,
     files: List[UploadFile] = File(..., description="Nuevas imágenes para añadir al ensayo"),
     current_user_id: str = Depends(get_current_user_id),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper:
         raise HTTPException(status_code=404, detail="Redacción no encontrada.")
     if db_exam_paper.user_id != current_user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso.")
+    _reject_pending_upload(db_exam_paper)
     # Lógica para añadir imágenes (similar a upload_multiple_exam_images, pero sin crear el paper)
+    if not STORAGE_CONFIGURED:
+        raise HTTPException(status_code=503, detail="Storage no configurado.")
     from uuid import uuid4
     uploaded_image_models = []
+    uploads: List[tuple[str, bytes, str]] = []
     for index, file_item in enumerate(files):
-        if not file_item.content_type or not file_item.content_type.startswith("image/"):
+        contents = await _read_upload_limited(file_item)
+        image_type = _detect_image_type(contents)
+        if image_type is None:
             raise HTTPException(status_code=400, detail=f"Archivo '{file_item.filename}' no es una imagen válida.")
-        contents = await file_item.read()
-        if len(contents) > MAX_UPLOAD_SIZE_BYTES:
-            raise HTTPException(status_code=413, detail=f"Archivo '{file_item.filename}' demasiado grande.")
-        file_extension = file_item.filename.split(".")[-1].lower() if file_item.filename and "." in file_item.filename else "png"
+        file_extension, image_content_type = image_type
         unique_storage_filename = f"page_{len(db_exam_paper.images)+index+1}_{uuid4().hex[:12]}.{file_extension}"
         path_on_storage = f"{db_exam_paper.user_id}/{db_exam_paper.id}/{unique_storage_filename}"
-        if not supabase_admin_client:
-            raise HTTPException(status_code=503, detail="Storage no configurado.")
-        supabase_admin_client.storage.from_(EXAM_IMAGES_BUCKET).upload(
-            path=path_on_storage, file=contents, file_options={"content-type": file_item.content_type, "cache-control": "3600"}
-        )
-        image_public_url = f"{SUPABASE_URL}/storage/v1/object/public/{EXAM_IMAGES_BUCKET}/{path_on_storage}"
+        uploads.append((path_on_storage, contents, image_content_type))
+    await _upload_images_to_storage(uploads)
+    for path_on_storage, _, _ in uploads:
+        image_public_url = f"{STORAGE_URL_PREFIX}{path_on_storage}"
         db_exam_image_data = models.ExamImageCreate(
             image_url=image_public_url,
             page_number=None,  # Se reordenará después
             exam_paper_id=db_exam_paper.id
         )
-        db_exam_image = models.ExamImage.model_validate(db_exam_image_data)
-        session.add(db_exam_image)
-        uploaded_image_models.append(db_exam_image)
-    session.commit()
-    # Recalcular page_number para todas las imágenes
-    all_images = session.exec(select(models.ExamImage).where(models.ExamImage.exam_paper_id == db_exam_paper.id)).all()
+        uploaded_image_models.append(models.ExamImage.model_validate(db_exam_image_data, update={"storage_path": path_on_storage}))
+    # Recalcular page_number para todas las imágenes: las existentes ya vienen cargadas con el
+    # paper (selectin) y las nuevas van al final. Todo se guarda en un único commit.
+    all_images = list(db_exam_paper.images) + uploaded_image_models
     for idx, img in enumerate(sorted(all_images, key=lambda x: x.page_number if x.page_number is not None else 9999)):
         img.page_number = idx + 1
-        session.add(img)
-    session.commit()
-    session.refresh(db_exam_paper)
+    session.add_all(all_images)
+    await session.commit()
+    await session.refresh(db_exam_paper, attribute_names=["images"])
     return db_exam_paper
 
 @app.delete("/exam_images/{image_id}", response_model=models.ExamPaperRead)
 async def delete_exam_image(
     image_id: int,
     current_user_id: str = Depends(get_current_user_id),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    db_exam_image = session.get(models.ExamImage, image_id)
+    db_exam_image = await session.get(models.ExamImage, image_id)
     if not db_exam_image:
         raise HTTPException(status_code=404, detail="Imagen no encontrada.")
-    db_exam_paper = session.get(models.ExamPaper, db_exam_image.exam_paper_id)
+    paper_id = db_exam_image.exam_paper_id
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper or db_exam_paper.user_id != current_user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso.")
-    # Eliminar de storage si es posible
-    if supabase_admin_client and db_exam_image.image_url:
-        from urllib.parse import urlparse
-        parsed = urlparse(db_exam_image.image_url)
-        path = parsed.path.split(f"/{EXAM_IMAGES_BUCKET}/")[-1]
-        supabase_admin_client.storage.from_(EXAM_IMAGES_BUCKET).remove([path])
-    session.delete(db_exam_image)
-    session.commit()
-    # Recalcular page_number
-    all_images = session.exec(select(models.ExamImage).where(models.ExamImage.exam_paper_id == db_exam_paper.id)).all()
-    for idx, img in enumerate(sorted(all_images, key=lambda x: x.page_number if x.page_number is not None else 9999)):
-        img.page_number = idx + 1
-        session.add(img)
-    session.commit()
-    session.refresh(db_exam_paper)
+    _reject_pending_upload(db_exam_paper)
+    path_on_storage = _image_storage_path(db_exam_image.storage_path, db_exam_image.image_url)
+
+    try:
+        # Las imágenes del paper ya están cargadas (selectin): se quita la borrada de la colección y se
+        # renumeran las demás, todo en un único commit y sin recargar el paper para la respuesta.
+        db_exam_paper.images.remove(db_exam_image)
+        await session.delete(db_exam_image)
+        for idx, img in enumerate(sorted(db_exam_paper.images, key=lambda x: x.page_number if x.page_number is not None else 9999)):
+            img.page_number = idx + 1
+        await session.commit()
+    except Exception as e_db:
+        if session.is_active:
+            await session.rollback()
+        logger.error("Error al eliminar la imagen ID: %s de la BD: %s", image_id, e_db)
+        raise HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error al eliminar la imagen.")
+
+    # Storage solo tras el commit, como en delete_exam_paper: si la BD falla, la imagen sigue entera.
+    await _remove_from_storage([path_on_storage] if path_on_storage else [], f"de la imagen {image_id}")
     return db_exam_paper
 
 @app.put("/exam_papers/{paper_id}/reorder_images", response_model=models.ExamPaperRead)
@@ -614,19 +1411,20 @@ async def reorder_exam_images(
     paper_id: int,
     order_update: ImagesOrderUpdate = Body(...),
     current_user_id: str = Depends(get_current_user_id),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    db_exam_paper = session.get(models.ExamPaper, paper_id)
+    db_exam_paper = await session.get(models.ExamPaper, paper_id)
     if not db_exam_paper or db_exam_paper.user_id != current_user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso.")
-    images = session.exec(select(models.ExamImage).where(models.ExamImage.exam_paper_id == paper_id)).all()
-    id_to_img = {img.id: img for img in images}
+    _reject_pending_upload(db_exam_paper)
+    id_to_img = {img.id: img for img in db_exam_paper.images}
     if set(order_update.image_ids) != set(id_to_img.keys()):
         raise HTTPException(status_code=400, detail="IDs de imágenes no coinciden con las del ensayo.")
     for idx, img_id in enumerate(order_update.image_ids):
         img = id_to_img[img_id]
         img.page_number = idx + 1
         session.add(img)
-    session.commit()
-    session.refresh(db_exam_paper)
-    return db_exam_paper
\ No newline at end of file
+    # Las imágenes modificadas son las mismas instancias de db_exam_paper.images: no hace falta
+    # recargar el paper tras el commit.
+    await session.commit()
+    return db_exam_paper
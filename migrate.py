@@ -0,0 +1,57 @@
+# my-english-corrector-backend/migrate.py
+# Aplica los cambios de esquema de migrations/*.sql que aún no se han aplicado en la BD.
+# Es el paso de release (Procfile: release); también se puede lanzar a mano: python migrate.py
+# Los archivos se aplican en orden de nombre (001, 002, 003...), una sola vez cada uno: los ya
+# aplicados quedan anotados en la tabla schema_migrations.
+import asyncio
+import logging
+import pathlib
+
+from sqlalchemy import text
+
+from main import engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = pathlib.Path(__file__).parent / "migrations"
+
+CREATE_SCHEMA_MIGRATIONS_STATEMENT = text(
+    "CREATE TABLE IF NOT EXISTS schema_migrations ("
+    "filename VARCHAR PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+)
+SELECT_APPLIED_MIGRATIONS_STATEMENT = text("SELECT filename FROM schema_migrations")
+RECORD_MIGRATION_STATEMENT = text("INSERT INTO schema_migrations (filename) VALUES (:filename)")
+
+
+def _sql_statements(sql_script: str) -> list[str]:
+    """
+    Separa un archivo de migración en sentencias (por ';'), sin las líneas de comentario.
+    Basta para los archivos de migrations/, que no llevan ';' dentro de cadenas ni bloques DO.
+    """
+    sql_lines = [line for line in sql_script.splitlines() if not line.lstrip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(sql_lines).split(";") if statement.strip()]
+
+
+async def apply_pending_migrations() -> None:
+    # AUTOCOMMIT: cada sentencia va en su propia transacción, como con psql -f. Así pueden ir
+    # sentencias que no admiten transacción (CREATE INDEX CONCURRENTLY en 003). Las migraciones son
+    # idempotentes (IF [NOT] EXISTS), así que un archivo que falle a medias se puede volver a lanzar.
+    try:
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            await connection.execute(CREATE_SCHEMA_MIGRATIONS_STATEMENT)
+            applied_migrations = set((await connection.execute(SELECT_APPLIED_MIGRATIONS_STATEMENT)).scalars())
+            for migration_path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+                if migration_path.name in applied_migrations:
+                    continue
+                logger.info("Aplicando migración %s...", migration_path.name)
+                for statement in _sql_statements(migration_path.read_text(encoding="utf-8")):
+                    await connection.exec_driver_sql(statement)
+                await connection.execute(RECORD_MIGRATION_STATEMENT, {"filename": migration_path.name})
+    finally:
+        await engine.dispose()
+    logger.info("Esquema de la BD al día.")
+
+
+if __name__ == "__main__":
+    asyncio.run(apply_pending_migrations())
@@ -0,0 +1,9 @@
+-- my-english-corrector-backend/migrations/001_exam_image_storage_path.sql
+-- Ruta del objeto dentro del bucket "exam-images" guardada junto a la imagen, para que los
+-- borrados no tengan que deducirla de la URL pública.
+ALTER TABLE examimage ADD COLUMN IF NOT EXISTS storage_path VARCHAR;
+
+-- Rellenar las filas existentes a partir de la URL pública (.../storage/v1/object/public/exam-images/<ruta>).
+UPDATE examimage
+SET storage_path = substring(image_url FROM '/storage/v1/object/public/exam-images/(.*)$')
+WHERE storage_path IS NULL;
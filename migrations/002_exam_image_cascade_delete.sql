@@ -0,0 +1,6 @@
+-- my-english-corrector-backend/migrations/002_exam_image_cascade_delete.sql
+-- Borrar una redacción borra sus imágenes en la propia BD (la API ya no las borra una a una).
+ALTER TABLE examimage DROP CONSTRAINT IF EXISTS examimage_exam_paper_id_fkey;
+ALTER TABLE examimage
+    ADD CONSTRAINT examimage_exam_paper_id_fkey
+    FOREIGN KEY (exam_paper_id) REFERENCES exampaper (id) ON DELETE CASCADE;
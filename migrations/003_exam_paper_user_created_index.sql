@@ -0,0 +1,7 @@
+-- my-english-corrector-backend/migrations/003_exam_paper_user_created_index.sql
+-- Índice compuesto para el listado de redacciones de un usuario (WHERE user_id ORDER BY created_at)
+-- y los recuentos de la cuota; sustituye al índice que solo cubría user_id.
+-- CONCURRENTLY no bloquea las escrituras mientras se construye, pero no puede ir dentro de una
+-- transacción: ejecutar este archivo sin BEGIN/COMMIT (p. ej. psql -f, no psql -1).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_exampaper_user_id_created_at ON exampaper (user_id, created_at);
+DROP INDEX CONCURRENTLY IF EXISTS ix_exampaper_user_id;
@@ -1,9 +1,17 @@
 # my-english-corrector-backend/models.py
 import os # <--- AÑADIR ESTA LÍNEA
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel, Relationship
 from datetime import datetime, timezone
 from typing import Optional, List
 
+__all__ = [
+    "UserBase", "User", "UserCreate", "UserRead", "UserUpdateCredits",
+    "ExamImageBase", "ExamImage", "ExamImageCreate", "ExamImageRead",
+    "ExamPaperBase", "ExamPaper", "ExamPaperCreate", "ExamPaperRead", "ExamPaperUpdate",
+    "TestItemBase", "TestItem", "TestItemCreate", "TestItemRead",
+]
+
 # --- Modelo de Usuario ---
 class UserBase(SQLModel):
     email: Optional[str] = Field(default=None, index=True)
@@ -26,10 +34,12 @@ class UserUpdateCredits(SQLModel):
 class ExamImageBase(SQLModel):
     image_url: str = Field(description="URL de la imagen en el almacenamiento")
     page_number: Optional[int] = Field(default=None, description="Número de página para ordenamiento")
-    exam_paper_id: Optional[int] = Field(default=None, foreign_key="exampaper.id", index=True)
+    exam_paper_id: Optional[int] = Field(default=None, foreign_key="exampaper.id", ondelete="CASCADE", index=True)
 
 class ExamImage(ExamImageBase, table=True):
     id: int = Field(default=None, primary_key=True)
+    # Ruta del objeto dentro del bucket (uso interno: no se expone en ExamImageRead).
+    storage_path: Optional[str] = Field(default=None, description="Ruta de la imagen dentro del bucket de almacenamiento")
     exam_paper: Optional["ExamPaper"] = Relationship(back_populates="images")
 
 class ExamImageCreate(ExamImageBase):
@@ -59,9 +69,14 @@ class ExamPaperBase(SQLModel):
     correction_credits_consumed: int = Field(default=0)
     correction_prompt_version: Optional[str] = Field(default=None, description="Versión del prompt de corrección utilizado")
 
-    user_id: str = Field(foreign_key="user.id", index=True)
+    # Sin índice propio: lo cubre ix_exampaper_user_id_created_at (ver ExamPaper).
+    user_id: str = Field(foreign_key="user.id")
 
 class ExamPaper(ExamPaperBase, table=True):
+    # (user_id, created_at) sirve el listado de un usuario ya ordenado y los recuentos por usuario
+    # de la cuota, sin ordenar ni leer la tabla. Hace innecesario un índice solo sobre user_id.
+    __table_args__ = (Index("ix_exampaper_user_id_created_at", "user_id", "created_at"),)
+
     id: int = Field(default=None, primary_key=True)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc),
@@ -71,7 +86,10 @@ class ExamPaper(ExamPaperBase, table=True):
     owner: Optional[User] = Relationship(back_populates="exam_papers")
     images: List["ExamImage"] = Relationship(
         back_populates="exam_paper",
-        sa_relationship_kwargs={'lazy': 'selectin'} 
+        # Al borrar la redacción el ORM borra también sus imágenes (ya cargadas por selectin). No se
+        # delega en el ON DELETE CASCADE de la BD (passive_deletes): una BD sin migrations/002
+        # rechazaría el DELETE de la redacción por la clave ajena.
+        sa_relationship_kwargs={'lazy': 'selectin', 'cascade': 'all, delete-orphan'}
     )
 
 class ExamPaperCreate(ExamPaperBase):
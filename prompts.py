@@ -74,7 +74,7 @@ Debes proporcionar un feedback estructurado y constructivo. Sigue este formato E
 **Nota Importante:** Sé específico en tus comentarios y proporciona ejemplos claros. El objetivo es educativo. Evita ser demasiado severo; enfócate en el aprendizaje.
 No reescribas la redacción completa. Solo proporciona ejemplos de corrección para ilustrar tus puntos.
 Utiliza Markdown para el formato del feedback (negritas, listas). Es crucial que sigas el formato Markdown exactamente como se describe.
-"""
+""".strip()  # Sin saltos de línea sobrantes; se limpia una sola vez al importar.
 
 # Versión actual de los prompts
 PROMPT_VERSION = "1.0"